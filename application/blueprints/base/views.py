@@ -1,7 +1,16 @@
 from flask import Blueprint, abort, render_template
-from sqlalchemy import text
-
-from application.models import DatasetReport, Organisation
+from sqlalchemy import and_
+from sqlalchemy.orm import defaultload, joinedload, undefer_group
+
+from application.extensions import page_cache
+from application.models import (
+    ActionCategory,
+    Dataset,
+    DatasetIssue,
+    DatasetReport,
+    LatestResource,
+    Organisation,
+)
 
 base = Blueprint("base", __name__)
 
@@ -14,61 +23,31 @@ def index():
 
 
 @base.route("/organisation/<string:organisation>")
+@page_cache.cached
 def org_summary(organisation):
-    from application.extensions import db
-
     organisation = Organisation.query.get(organisation)
     if not organisation:
         abort(404)
 
-    query = f"""
-        SELECT d.dataset as dataset, r.resource as resource, o.organisation as organisation, r.start_date as start_date
-        FROM dataset d, resource r, dataset_resource dr, organisation o, organisation_resource orgr
-        WHERE d.dataset = dr.dataset
-        AND r.resource = dr.resource
-        AND dr.resource = orgr.resource
-        AND o.organisation = orgr.organisation
-        AND o.organisation = '{organisation.organisation}'
-        ORDER BY d.dataset, r.start_date;
-    """
-
-    sql = text(query)
-    results = db.session.execute(sql).fetchall()
-    latest_resource_map = {}
-    for result in results:
-        dataset = result.dataset
-        resource = result.resource
-        start_date = result.start_date
-        if dataset not in latest_resource_map:
-            latest_resource_map[dataset] = {
-                "resource": resource,
-                "start_date": start_date,
-            }
-        else:
-            if latest_resource_map[dataset]["start_date"] < start_date:
-                latest_resource_map[dataset] = {
-                    "resource": resource,
-                    "start_date": start_date,
-                }
-
-    reports = []
-
-    for item, data in latest_resource_map.items():
-        resource = data.get("resource")
-        r = DatasetReport.query.filter(
-            DatasetReport.dataset_id == item,
-            DatasetReport.resource_id == resource,
-            DatasetReport.organisation_id == organisation.organisation,
-        ).one_or_none()
-        if r is not None:
-            reports.append(r)
-
-    last_update = None
-    for report in reports:
-        if last_update is None:
-            last_update = report.created_date
-        elif report.created_date > last_update:
-            last_update = report.created_date
+    reports = (
+        DatasetReport.query.join(
+            LatestResource,
+            and_(
+                LatestResource.organisation == DatasetReport.organisation_id,
+                LatestResource.dataset == DatasetReport.dataset_id,
+                LatestResource.resource == DatasetReport.resource_id,
+            ),
+        )
+        .filter(LatestResource.organisation == organisation.organisation)
+        .options(
+            joinedload(DatasetReport.dataset).lazyload(Dataset.resources),
+            undefer_group("status"),
+        )
+        .order_by(DatasetReport.dataset_id)
+        .all()
+    )
+
+    last_update = max((report.created_date for report in reports), default=None)
 
     return render_template(
         "organisation-summary.html",
@@ -81,13 +60,24 @@ def org_summary(organisation):
 @base.route(
     "/organisation/<string:organisation>/<string:dataset>/<string:resource>/feedback"
 )
+@page_cache.cached
 def dataset_feedback(organisation, dataset, resource):
 
-    report = DatasetReport.query.filter(
-        DatasetReport.organisation_id == organisation,
-        DatasetReport.dataset_id == dataset,
-        DatasetReport.resource_id == resource,
-    ).one_or_none()
+    report = (
+        DatasetReport.query.options(
+            joinedload(DatasetReport.dataset).lazyload(Dataset.resources),
+            joinedload(DatasetReport.organisation),
+            joinedload(DatasetReport.summary),
+            # only loaded if the summary says there's something to show
+            defaultload(DatasetReport.dataset_issues).joinedload(DatasetIssue.issue),
+        )
+        .filter(
+            DatasetReport.organisation_id == organisation,
+            DatasetReport.dataset_id == dataset,
+            DatasetReport.resource_id == resource,
+        )
+        .one_or_none()
+    )
     if report is None:
         abort(404)
 
@@ -95,7 +85,12 @@ def dataset_feedback(organisation, dataset, resource):
     changes = []
     checks = []
 
-    for issue in report.get_additions():
+    if report.summary is not None and not report.summary.action_counts:
+        issues = {action: [] for action in ActionCategory}
+    else:
+        issues = report.get_issues_by_action()
+
+    for issue in issues[ActionCategory.add]:
         additions.append(
             {
                 "type": "mandatory",
@@ -104,7 +99,7 @@ def dataset_feedback(organisation, dataset, resource):
             }
         )
 
-    for issue in report.get_changes():
+    for issue in issues[ActionCategory.change]:
         changes.append(
             {
                 "type": "recommendation",
@@ -113,7 +108,7 @@ def dataset_feedback(organisation, dataset, resource):
             }
         )
 
-    for issue in report.get_checks():
+    for issue in issues[ActionCategory.check]:
         checks.append(
             {
                 "type": "recommendation",
@@ -0,0 +1,93 @@
+import datetime
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request
+from sqlalchemy.dialects.postgresql import insert
+
+
+def get_generation():
+    from application.models import DataGeneration
+
+    generation = DataGeneration.query.get("data")
+    return generation.generation if generation is not None else 0
+
+
+def bump_generation(session):
+    """
+    Marks the data pages are built from as changed. Call it in the
+    transaction that changes the data, so the new generation is seen
+    exactly when the data is.
+    """
+    from application.models import DataGeneration
+
+    stmt = insert(DataGeneration).values(
+        name="data", generation=1, updated_date=datetime.datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DataGeneration.name],
+        set_=dict(
+            generation=DataGeneration.generation + 1,
+            updated_date=stmt.excluded.updated_date,
+        ),
+    )
+    session.execute(stmt)
+
+
+class PageCache:
+    """
+    Keeps the most recently rendered pages in memory, up to
+    PAGE_CACHE_SIZE of them. Pages are cached against the data generation,
+    which the data commands bump when they change the data, so a page is
+    only rendered again once its data has changed. The generation is also
+    the ETag, so browsers and crawlers that already have the page get a
+    304 Not Modified.
+    """
+
+    def __init__(self, app=None):
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        self.size = 256
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.size = app.config.get("PAGE_CACHE_SIZE", self.size)
+
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+            return page
+
+    def set(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def cached(self, view):
+        @wraps(view)
+        def cached_view(*args, **kwargs):
+            generation = get_generation()
+            etag = f"{generation}-{current_app.config['RELEASE_VERSION']}"
+            if request.if_none_match.contains(etag):
+                response = make_response("", 304)
+            else:
+                # views don't use the query string, so it's left out of the
+                # key rather than letting it fill the cache
+                key = (request.path, etag)
+                page = self.get(key)
+                if page is None:
+                    page = view(*args, **kwargs)
+                    self.set(key, page)
+                response = make_response(page)
+            response.set_etag(etag)
+            # stored but checked with the etag each time
+            response.cache_control.no_cache = True
+            return response
+
+        return cached_view
@@ -1,361 +1,409 @@
-import concurrent
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
-import requests
+import click
 from flask.cli import AppGroup
-from sqlalchemy import delete, text
-from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy import delete, func, text
 
+from application.cache import bump_generation
 from application.extensions import db
+from application.ingest import create_shadow_tables, search_path, swap_shadow_tables
+from application.jobs import Worker, enqueue
+from application.loader import (
+    LoadRun,
+    get_watermarks,
+    load_stages,
+    refresh_latest_resources,
+    set_watermark,
+)
+from application.metrics import Metrics
 from application.models import (
     Collection,
     Dataset,
     DatasetIssue,
     DatasetReport,
-    IssueCategory,
+    DatasetReportSummary,
+    IssueCache,
     IssueType,
+    LatestResource,
+    LoadCheckpoint,
     Organisation,
     Resource,
+    SyncWatermark,
     dataset_resource,
-    issue_type_to_category,
     organisation_resource,
 )
+from application.report import (
+    report_process,
+    report_resource,
+    report_work,
+    run_reports,
+    save_missing_summaries,
+)
+from application.scheduler import run_stages
+from application.sources import DatasetteSource, SqliteSource
 
 data_cli = AppGroup("data")
 
 logger = logging.getLogger(__name__)
 
-resource_organisation_sql = """
-SELECT resource, organisation
-FROM resource_organisation;
-"""
-
-collection_sql = """
-SELECT collection
-FROM collection
-"""
-
-dataset_sql = """
-SELECT dataset, name, collection AS collection_id
-FROM dataset
-WHERE ("collection" IS NOT NULL AND "collection" != "");
-"""
-
-organisation_sql = """
-SELECT
-  name,
-  organisation
-FROM
-  organisation
-WHERE
-  (
-    organisation LIKE 'local-authority%'
-    or organisation LIKE 'development-corporation%'
-    or organisation LIKE 'national-park-authority%'
-  )
-  AND (
-    "entry_date" IS NULL
-    OR "entry_date" = ""
-  );
-"""
-
-issue_type_sql = """
-SELECT
-  i.issue_type,
-  i.name AS issue_name,
-  i.description AS issue_description,
-  s.severity AS severity,
-  s.name AS severity_name,
-  s.description AS severity_description
-FROM
-  issue_type i,
-  severity s
-WHERE
-  i.severity = s.severity;
-"""
-
 
 @data_cli.command("load")
-def load_data():
+@click.option(
+    "--copy",
+    is_flag=True,
+    help="Stream the large tables in with COPY via unlogged staging tables",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only fetch resources started or ended since the last sync",
+)
+@click.option(
+    "--from-sqlite",
+    "sqlite_path",
+    type=click.Path(exists=True, dir_okay=False),
+    help="Load from a local digital-land sqlite database instead of datasette",
+)
+@click.option(
+    "--swap",
+    is_flag=True,
+    help="Load into a shadow schema and swap it in once complete",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    help="Carry on from the checkpoints left by a load that failed",
+)
+@click.option(
+    "--only",
+    multiple=True,
+    type=click.Choice(list(load_stages)),
+    help="Only run this stage, can be given more than once",
+)
+@click.option(
+    "--skip",
+    multiple=True,
+    type=click.Choice(list(load_stages)),
+    help="Don't run this stage, can be given more than once",
+)
+def load_data(copy, incremental, sqlite_path, swap, resume, only, skip):
 
-    from flask import current_app
+    if incremental and swap:
+        raise click.UsageError("--incremental can't be used with --swap")
 
-    datasette_url = current_app.config["DATASETTE_URL"]
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    failed = run_load(copy, incremental, sqlite_path, swap, resume, only, skip)
 
-    print("load organisations")
-    url = (
-        f"{datasette_url}/digital-land.json?sql={organisation_sql.strip()}&_shape=array"
-    )
-    resp = requests.get(url)
-    resp.raise_for_status()
-    data = resp.json()
-    inserts = []
-    # remove -eng from local-authority ids until digital  land db catches up
-    for org in data:
-        inserts.append(
-            {
-                "name": org["name"],
-                "organisation": org["organisation"].replace("-eng", ""),
-            }
-        )
+    if failed:
+        raise click.ClickException(f"failed to load {', '.join(sorted(failed))}")
 
-    stmt = insert(Organisation).values(inserts)
-    stmt = stmt.on_conflict_do_update(
-        index_elements=[Organisation.organisation], set_=dict(name=stmt.excluded.name)
-    )
 
-    db.session.execute(stmt)
-    db.session.commit()
-    print("load organisations done")
-
-    print("load issue type")
-    url = f"{datasette_url}/digital-land.json?sql={issue_type_sql.strip()}&_shape=array"
-    resp = requests.get(url)
-    resp.raise_for_status()
-    data = resp.json()
-    for row in data:
-        row["category"] = issue_type_to_category.get(
-            row.get("issue_name"), IssueCategory.unknown
-        ).name
-    stmt = insert(IssueType).values(data)
-    db.session.execute(stmt)
-    db.session.commit()
-    print("load issue type done")
-
-    print("load resource")
-    url = f"{datasette_url}/digital-land/resource.json?_shape=array&_col=resource&_col=start_date&_col=end_date"
-
-    while url is not None:
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = resp.json()
-        try:
-            url = resp.links.get("next").get("url")
-        except AttributeError:
-            url = None
-        inserts = []
-        for item in data:
-            resource = item.get("resource")
-            start_date = item.get("start_date") if item.get("start_date") else None
-            end_date = item.get("end_date") if item.get("end_date") else None
-            inserts.append(
-                {"resource": resource, "start_date": start_date, "end_date": end_date}
+def run_load(
+    copy=False,
+    incremental=False,
+    sqlite_path=None,
+    swap=False,
+    resume=False,
+    only=(),
+    skip=(),
+):
+    """
+    Runs the selected load stages and returns the names of any stages, or
+    datasets whose resources couldn't be fetched, that failed. The shadow
+    tables are only swapped in if there were none.
+    """
+
+    from flask import current_app
+
+    if sqlite_path:
+        source = SqliteSource(sqlite_path, batch_size=current_app.config["BATCH_SIZE"])
+    else:
+        source = DatasetteSource(
+            current_app.config["DATASETTE_URL"],
+            workers=current_app.config["FETCH_WORKERS"],
+            retries=current_app.config["FETCH_RETRIES"],
+            batch_size=current_app.config["BATCH_SIZE"],
+        )
+    metrics = Metrics("load", sink_url=current_app.config["METRICS_URL"])
+    selected = [
+        name for name in load_stages if (not only or name in only) and name not in skip
+    ]
+
+    try:
+        if not resume:
+            db.session.execute(delete(LoadCheckpoint))
+            db.session.commit()
+
+        if swap and not resume:
+            # stages that aren't run keep their current data
+            unselected = [name for name in load_stages if name not in selected]
+            create_shadow_tables(db.session, list(load_stages), copy=unselected)
+
+        with source, search_path(db.session, "shadow" if swap else None):
+            run = LoadRun(source, metrics, copy=copy, incremental=incremental)
+            for name in selected:
+                metrics.stage(name)
+            failed = run_stages(
+                {
+                    name: (depends, partial(load, run))
+                    for name, (depends, load) in load_stages.items()
+                },
+                selected,
             )
-        stmt = insert(Resource).values(inserts)
-        db.session.execute(stmt)
+
+        failed |= run.failed
+        if swap and not failed:
+            with metrics.timed("swap"):
+                swap_shadow_tables(db.session, list(load_stages))
+
+        if failed:
+            if swap:
+                print("not swapping in the shadow tables as the load failed")
+            print("use --resume to carry on from where the load got to")
+        else:
+            db.session.execute(delete(LoadCheckpoint))
+            db.session.commit()
+
+        with metrics.timed("latest_resource"):
+            refresh_latest_resources(db.session)
+        metrics.summary()
+        return failed
+    finally:
+        # stages commit as they go, so whatever they loaded is shown even
+        # if the load stops part way
+        db.session.rollback()
+        bump_generation(db.session)
         db.session.commit()
 
-    print("load resource done")
-
-    print("load resource_organisation")
-    url = f"{datasette_url}/digital-land/resource_organisation.json?_shape=array"
-    while url is not None:
-        resp = requests.get(url)
-        resp.raise_for_status()
-        data = resp.json()
-        try:
-            url = resp.links.get("next").get("url")
-        except AttributeError:
-            url = None
-        inserts = []
-        for item in data:
-            organisation = item.get("organisation").replace("-eng", "")
-            if Organisation.query.get(organisation) is not None:
-                resource = item.get("resource")
-                if organisation and resource:
-                    inserts.append({"resource": resource, "organisation": organisation})
-        if inserts:
-            print(f"inserting {len(inserts)} organisation resources")
-            stmt = insert(organisation_resource).values(inserts)
+
+@data_cli.command("drop")
+@click.option(
+    "--truncate",
+    is_flag=True,
+    help="Empty the tables with TRUNCATE rather than deleting rows",
+)
+def drop_data(truncate):
+
+    models = [
+        DatasetIssue,
+        DatasetReportSummary,
+        DatasetReport,
+        LatestResource,
+        organisation_resource,
+        dataset_resource,
+        Dataset,
+        Collection,
+        Organisation,
+        Resource,
+        IssueType,
+        SyncWatermark,
+        LoadCheckpoint,
+        IssueCache,
+    ]
+
+    if truncate:
+        tables = ", ".join(getattr(m, "__table__", m).name for m in models)
+        db.session.execute(text(f"TRUNCATE {tables} CASCADE"))
+    else:
+        for model in models:
+            stmt = delete(model)
             db.session.execute(stmt)
-            db.session.commit()
-    print("load resource_organisation done")
-
-    print("load collections")
-    url = f"{datasette_url}/digital-land.json?sql={collection_sql.strip()}&_shape=array"
-    resp = requests.get(url)
-    resp.raise_for_status()
-    data = resp.json()
-    stmt = insert(Collection).values(data)
-    db.session.execute(stmt)
-    db.session.commit()
-    print("load collections done")
-
-    print("load datasets")
-    url = f"{datasette_url}/digital-land.json?sql={dataset_sql.strip()}&_shape=array"
-    resp = requests.get(url)
-    resp.raise_for_status()
-    data = resp.json()
-    stmt = insert(Dataset).values(data)
-    db.session.execute(stmt)
+
+    bump_generation(db.session)
     db.session.commit()
-    print("load datasets done")
-
-    print("load dataset resources")
-    datasets = Dataset.query.all()
-    for dataset in datasets:
-        url = f"{datasette_url}/{dataset.dataset}/dataset_resource.json?_shape=array&_col=resource&_col=dataset"
-        print(f"dataset: {dataset.dataset} url: {url}")
-        while url is not None:
-            try:
-                resp = requests.get(url)
-                resp.raise_for_status()
-            except Exception as e:
-                print(e)
-                url = None
-                continue
-            data = resp.json()
-            inserts = []
-            for item in data:
-                resource = item.get("resource")
-                ds = item.get("dataset")
-                if resource and dataset:
-                    inserts.append({"resource": resource, "dataset": ds})
-            try:
-                url = resp.links.get("next").get("url")
-            except AttributeError:
-                url = None
-            if inserts:
-                print(
-                    f"inserting {len(inserts)} dataset resources for {dataset.dataset}"
-                )
-                stmt = insert(dataset_resource).values(inserts)
-                db.session.execute(stmt)
-                db.session.commit()
-    print("load datasets done")
 
 
-@data_cli.command("drop")
-def drop_data():
+def parse_shard(ctx, param, value):
+    if value is None:
+        return 0, 1
+    try:
+        shard, shards = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("should be N/M, e.g. 2/4")
+    if not 1 <= shard <= shards:
+        raise click.BadParameter("N should be between 1 and M")
+    return shard - 1, shards
 
-    stmt = delete(DatasetIssue)
-    db.session.execute(stmt)
 
-    stmt = delete(DatasetReport)
-    db.session.execute(stmt)
+@data_cli.command("report")
+@click.option(
+    "--shard",
+    callback=parse_shard,
+    help="Only generate shard N of M of the reports, e.g. 2/4",
+)
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Split the reports between this many local processes",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only generate missing reports and reports for resources started since the last run",
+)
+@click.option(
+    "--resources-per-request",
+    type=click.IntRange(1, 100),
+    default=1,
+    help="Fetch the issues for up to this many resources of a dataset in each request",
+)
+def create_dataset_issue_report(shard, workers, incremental, resources_per_request):
 
-    stmt = delete(organisation_resource)
-    db.session.execute(stmt)
+    from flask import current_app
 
-    stmt = delete(dataset_resource)
-    db.session.execute(stmt)
+    url = current_app.config["ISSUES_URL"]
+    shard, shards = shard
+
+    # shards keep their own watermark as they may not all succeed
+    watermark = "dataset_report"
+    if shards > 1:
+        watermark += f" {shard + 1}/{shards}"
+    since = get_watermarks().get(watermark) if incremental else None
+    synced_date = db.session.query(func.max(Resource.start_date)).scalar()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    metrics = Metrics("report", sink_url=current_app.config["METRICS_URL"])
+    with metrics.timed("report") as stage:
+        if workers == 1:
+            app = current_app._get_current_object()
+            count, failed = run_reports(
+                app, url, shard, shards, since, resources_per_request, stage
+            )
+        else:
+            count, failed = 0, []
+            # each process takes a slice of this shard, shard + shards * n of
+            # shards * workers picks the same work as shard of shards between them
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        report_process,
+                        url,
+                        shard + shards * n,
+                        shards * workers,
+                        since,
+                        resources_per_request,
+                    )
+                    for n in range(workers)
+                ]
+                for future in futures:
+                    reports, failures, counters = future.result()
+                    count += reports
+                    failed += failures
+                    stage.add(**counters)
+    with metrics.timed("report_summary"):
+        save_missing_summaries(db.session)
+    with metrics.timed("latest_resource"):
+        refresh_latest_resources(db.session)
+    metrics.summary()
+
+    if failed:
+        print(f"{len(failed)} of {count} reports failed")
+    else:
+        set_watermark(watermark, synced_date)
+
+
+@data_cli.command("enqueue")
+@click.argument("kind", type=click.Choice(["report", "load"]))
+@click.option(
+    "--incremental",
+    is_flag=True,
+    help="Only queue the work an incremental run would do",
+)
+@click.option(
+    "--priority",
+    type=int,
+    default=0,
+    help="Jobs with a higher priority are run first",
+)
+def enqueue_jobs(kind, incremental, priority):
 
-    stmt = delete(Dataset)
-    db.session.execute(stmt)
+    if kind == "load":
+        jobs = [
+            {
+                "kind": "load",
+                "key": "load",
+                "payload": {"incremental": incremental},
+                "priority": priority,
+            }
+        ]
+    else:
+        since = get_watermarks().get("dataset_report") if incremental else None
+        synced_date = db.session.query(func.max(Resource.start_date)).scalar()
+        jobs = [
+            {
+                "kind": "report",
+                "key": f"report:{dataset}:{resource}",
+                "payload": {
+                    "dataset": dataset,
+                    "resource": resource,
+                    "organisations": organisations,
+                },
+                "priority": priority,
+            }
+            for dataset, resource, organisations in report_work(db.session, since=since)
+        ]
 
-    stmt = delete(Collection)
-    db.session.execute(stmt)
+    enqueue(db.session, jobs)
+    if kind == "report":
+        # queued jobs are retried until they succeed or run out of attempts,
+        # failed ones can be queued again with a full enqueue
+        set_watermark("dataset_report", synced_date)
+    print(f"queued {len(jobs)} {kind} jobs")
 
-    stmt = delete(Organisation)
-    db.session.execute(stmt)
 
-    stmt = delete(Resource)
-    db.session.execute(stmt)
+def run_report_job(job):
+    from flask import current_app
 
-    stmt = delete(IssueType)
-    db.session.execute(stmt)
+    payload = job.payload
+    failed = report_resource(
+        current_app._get_current_object(),
+        current_app.config["ISSUES_URL"],
+        payload["dataset"],
+        payload["resource"],
+        payload["organisations"],
+    )
+    if failed:
+        raise RuntimeError(f"{len(failed)} reports failed")
 
-    db.session.commit()
+
+def run_load_job(job):
+    # later attempts carry on from where the last one got to
+    failed = run_load(
+        incremental=job.payload.get("incremental", False), resume=job.attempts > 1
+    )
+    # a partial load is retried too, including datasets that couldn't be
+    # fetched, as resuming only fetches what isn't complete
+    if failed:
+        raise RuntimeError(f"failed to load {', '.join(sorted(failed))}")
 
 
-@data_cli.command("report")
-def create_dataset_issue_report():
+job_handlers = {"report": run_report_job, "load": run_load_job}
+
+
+@data_cli.command("worker")
+@click.option("--burst", is_flag=True, help="Exit once the queue is empty")
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=5,
+    help="Seconds to wait before looking again when the queue is empty",
+)
+def run_worker(burst, poll_interval):
 
     from flask import current_app
 
-    url = "https://digital-land-issues.herokuapp.com/dataset-issue"
-
-    query = """SELECT d.dataset, r.resource, o.organisation
-    FROM dataset d, resource r, dataset_resource dr, organisation o, organisation_resource orgr
-    WHERE d.dataset = dr.dataset
-    AND r.resource = dr.resource
-    AND dr.resource = orgr.resource
-    AND o.organisation = orgr.organisation
-    ORDER BY d.dataset"""
-
-    sql = text(query)
-    datasets = db.session.execute(sql).fetchall()
-
-    dataset_issue_reports = []
-    for ds in datasets:
-        dataset_issue_reports.append({"url": url, "dataset": ds})
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for item in dataset_issue_reports:
-            futures.append(
-                executor.submit(
-                    generate_report,
-                    base_url=item["url"],
-                    ds=item["dataset"],
-                    app_context=current_app.app_context(),
-                )
-            )
-        for future in concurrent.futures.as_completed(futures):
-            print(future.result())
-
-
-def generate_report(base_url, ds, app_context):
-    with app_context:
-        dataset = ds[0]
-        resource = ds[1]
-        organisation = ds[2]
-        issue_url = f"{base_url}/{dataset}-issue.json?_shape=array&_col=resource&_col=field&_col=value&_col=issue-type&_col=line-number&resource__exact={resource}"  # noqa
-        while issue_url is not None:
-            try:
-                resp = requests.get(issue_url)
-                issue_data = resp.json()
-                if issue_data:
-                    report = DatasetReport.query.filter(
-                        DatasetReport.dataset_id == dataset,
-                        DatasetReport.resource_id == resource,
-                        DatasetReport.organisation_id == organisation,
-                    ).one_or_none()
-                    if report is None:
-                        report = DatasetReport(
-                            dataset_id=dataset,
-                            resource_id=resource,
-                            organisation_id=organisation,
-                        )
-                        db.session.add(report)
-                        db.session.flush()
-                        print(
-                            f"created report dataset: {dataset} | resource: {resource} | organisation: {organisation}"
-                        )
-                    else:
-                        print(
-                            f"update report dataset: {dataset} | resource: {resource} | organisation: {organisation}"
-                        )
-                    for issue in issue_data:
-                        issue_type = issue.get("issue-type")
-                        field = issue.get("field")
-                        if issue_type.lower() != "unknown entity":
-                            dataset_issue = DatasetIssue.query.filter(
-                                DatasetIssue.dataset_report_id == report.id,
-                                DatasetIssue.issue_type == issue_type,
-                                DatasetIssue.field == field,
-                            ).one_or_none()
-                            if dataset_issue is None:
-                                dataset_issue = DatasetIssue(
-                                    issue_type=issue["issue-type"],
-                                    field=field,
-                                    lines=[issue["line-number"]],
-                                )
-                                report.dataset_issues.append(dataset_issue)
-                            else:
-                                dataset_issue.count += 1
-                                dataset_issue.lines.append(issue["line-number"])
-
-                    db.session.add(report)
-                    db.session.commit()
-
-                try:
-                    issue_url = resp.links.get("next").get("url")
-                except AttributeError:
-                    issue_url = None
-
-            except Exception as e:
-                print(e)
-                issue_url = None
-
-        return f"completed report dataset: {dataset} | resource: {resource} | organisation: {organisation}"
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    worker = Worker(
+        current_app._get_current_object(),
+        job_handlers,
+        Metrics("worker"),
+        lease=current_app.config["JOB_LEASE"],
+        poll_interval=poll_interval,
+    )
+    worker.run(burst=burst)
@@ -1,5 +1,8 @@
 from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 
+from application.cache import PageCache
+
 db = SQLAlchemy()
 migrate = Migrate(db=db)
+page_cache = PageCache()
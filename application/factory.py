@@ -71,10 +71,11 @@ def register_filters(app):
 
 
 def register_extensions(app):
-    from application.extensions import db, migrate
+    from application.extensions import db, migrate, page_cache
 
     db.init_app(app)
     migrate.init_app(app)
+    page_cache.init_app(app)
 
 
 def register_templates(app):
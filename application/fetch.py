@@ -0,0 +1,286 @@
+import csv
+import io
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from application.metrics import Stage
+
+_done = object()
+
+# the connection dropping part way through a response body, which Retry
+# doesn't cover as it only retries connecting and bad statuses
+stream_errors = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.ReadTimeoutError,
+)
+
+
+def create_session(pool_size=8, retries=3, backoff_factor=0.5):
+    """
+    Keep-alive session with a connection pool big enough for every worker
+    and retry with exponential backoff on connection errors and 429/5xx
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class TimedReader(io.RawIOBase):
+    """
+    Wraps a response body to count the bytes read and the time spent
+    waiting on the network for them
+    """
+
+    def __init__(self, raw, stage):
+        self.raw = raw
+        self.stage = stage
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        count = self.raw.readinto(buffer)
+        self.stage.add(network=time.perf_counter() - start, bytes=count or 0)
+        return count
+
+
+def retries(resp):
+    if resp.raw is None or resp.raw.retries is None:
+        return 0
+    return len(resp.raw.retries.history)
+
+
+def stream_rows(session, url, batch_size=1000, stage=None):
+    """
+    Streams a datasette csv export (use _stream=on to get every row rather
+    than the first page) and yields the rows in lists of at most batch_size,
+    so memory stays flat however big the table is
+    """
+    stage = stage or Stage(url)
+    start = time.perf_counter()
+    with session.get(url, stream=True) as resp:
+        resp.raise_for_status()
+        stage.add(network=time.perf_counter() - start, retries=retries(resp))
+        resp.raw.decode_content = True
+        body = io.BufferedReader(TimedReader(resp.raw, stage))
+        reader = csv.DictReader(io.TextIOWrapper(body, encoding="utf-8", newline=""))
+        batch = []
+        for row in reader:
+            batch.append(row)
+            if len(batch) == batch_size:
+                stage.add(fetch=time.perf_counter() - start, rows=len(batch), batches=1)
+                yield batch
+                start = time.perf_counter()
+                batch = []
+        if batch:
+            stage.add(fetch=time.perf_counter() - start, rows=len(batch), batches=1)
+            yield batch
+
+
+def resume_rows(
+    session,
+    url,
+    resume,
+    key,
+    batch_size=1000,
+    retries=3,
+    backoff_factor=0.5,
+    stage=None,
+):
+    """
+    stream_rows for an export sorted by key that starts again, with
+    backoff, from the last key seen if the connection drops part way
+    through. resume(last) gives the url of the rows from last on, so rows
+    with that key come again and must be safe to write twice.
+    """
+    stage = stage or Stage(url)
+    last = None
+    for attempt in range(retries + 1):
+        try:
+            for batch in stream_rows(session, url, batch_size, stage):
+                last = batch[-1][key]
+                yield batch
+            return
+        except stream_errors as e:
+            if attempt == retries:
+                raise
+            print(f"stream failed, resuming from {last}: {e}")
+            stage.add(retries=1)
+            time.sleep(backoff_factor * 2**attempt)
+            if last is not None:
+                url = resume(last)
+
+
+def create_async_client(connections=20, timeout=30):
+    """
+    asyncio client that keeps at most connections open at once. Reports
+    fetch from a single host so this is the limit per host too, requests
+    over it wait for a free connection rather than time out.
+    """
+    limits = httpx.Limits(
+        max_connections=connections, max_keepalive_connections=connections
+    )
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout, pool=None))
+
+
+def split_records(text, partial=""):
+    """
+    Splits csv text into complete records. A newline inside quotes doesn't
+    end a record, so a record is only complete once its quotes balance.
+    Returns the records and whatever is left over for the next chunk.
+    """
+    lines = (partial + text).split("\n")
+    partial = lines.pop()
+    records, record = [], ""
+    for line in lines:
+        record += line + "\n"
+        if record.count('"') % 2 == 0:
+            records.append(record)
+            record = ""
+    return records, record + partial
+
+
+async def aiter_records(resp):
+    partial = ""
+    async for text in resp.aiter_text():
+        records, partial = split_records(text, partial)
+        yield records
+    yield [partial]
+
+
+async def aread_rows(resp, batch_size=1000, stage=None):
+    """
+    asyncio version of stream_rows for a response opened with
+    client.stream, yields the rows of a datasette csv export in lists of
+    at most batch_size as the body arrives
+    """
+    stage = stage or Stage(str(resp.url))
+    start = time.perf_counter()
+    header, batch = None, []
+    async for records in aiter_records(resp):
+        for row in csv.reader(records):
+            if not row:
+                continue
+            if header is None:
+                header = row
+                continue
+            batch.append(dict(zip(header, row)))
+            if len(batch) == batch_size:
+                stage.add(fetch=time.perf_counter() - start, rows=len(batch), batches=1)
+                yield batch
+                start = time.perf_counter()
+                batch = []
+    stage.add(bytes=resp.num_bytes_downloaded)
+    if batch:
+        stage.add(fetch=time.perf_counter() - start, rows=len(batch), batches=1)
+        yield batch
+
+
+class Fetcher:
+    """
+    Fetches datasette urls on a bounded pool of worker threads.
+
+    Tables are streamed in the background and handed back in batches through
+    a bounded queue, so the caller can write one batch while the following
+    ones are downloaded. Results are always consumed in the order they were
+    requested, which keeps inserts deterministic. Because of that, iterators
+    and futures should be consumed in the order they were created.
+    """
+
+    def __init__(self, session, max_workers=8, prefetch=4, retries=3):
+        self.session = session
+        self.prefetch = prefetch
+        self.retries = retries
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.closed = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.closed.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def get(self, url, stage=None):
+        return self.executor.submit(self._get_json, url, stage or Stage(url))
+
+    def stream(self, url, batch_size=1000, stage=None, resume=None, key=None):
+        """
+        With resume and key, see resume_rows, a dropped connection picks up
+        where it got to rather than failing the stream
+        """
+        if resume is None:
+            batches = stream_rows(self.session, url, batch_size, stage)
+        else:
+            batches = resume_rows(
+                self.session, url, resume, key, batch_size, self.retries, stage=stage
+            )
+        return self._background(batches)
+
+    def _background(self, batches):
+        queued = queue.Queue(maxsize=self.prefetch)
+        self.executor.submit(self._produce, batches, queued)
+        return self._drain(queued)
+
+    def _get_json(self, url, stage):
+        with stage.timer("fetch"):
+            with stage.timer("network"):
+                resp = self.session.get(url)
+                resp.raise_for_status()
+            data = resp.json()
+        stage.add(rows=len(data), batches=1, bytes=len(resp.content))
+        stage.add(retries=retries(resp))
+        return data
+
+    def _produce(self, batches, queued):
+        try:
+            for batch in batches:
+                if self.closed.is_set():
+                    break
+                self._put(queued, batch)
+        except Exception as e:
+            self._put(queued, e)
+        finally:
+            batches.close()
+        self._put(queued, _done)
+
+    def _put(self, queued, item):
+        while not self.closed.is_set():
+            try:
+                queued.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _drain(self, queued):
+        while True:
+            item = queued.get()
+            if item is _done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
@@ -0,0 +1,231 @@
+import csv
+import io
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event, text
+
+
+class CopyStream:
+    """
+    File like object that renders rows as csv on demand so COPY FROM STDIN
+    can stream an iterator of dicts without materialising it
+    """
+
+    def __init__(self, rows, columns):
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator="\n")
+        self.count = 0
+        self.waiting = 0
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer.tell() < size:
+            start = time.perf_counter()
+            row = next(self.rows, None)
+            self.waiting += time.perf_counter() - start
+            if row is None:
+                break
+            # None is written as an unquoted empty field which COPY reads as NULL
+            self.writer.writerow([row.get(column) for column in self.columns])
+            self.count += 1
+        data = self.buffer.getvalue()
+        rest = ""
+        if 0 <= size < len(data):
+            data, rest = data[:size], data[size:]
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(rest)
+        return data
+
+
+def copy_rows(session, table, columns, rows, update=None, stage=None):
+    """
+    Streams rows into an unlogged staging copy of table with COPY and then
+    merges them in with a single INSERT ... SELECT. Rows already present are
+    skipped unless update lists the columns to overwrite. Returns the number
+    of rows streamed. Time spent writing, excluding time spent waiting on
+    rows, is added to stage if given.
+    """
+    start = time.perf_counter()
+    staging = f"{table.name}_staging"
+    column_list = ", ".join(columns)
+    connection = session.connection()
+    connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+    connection.execute(
+        text(f"CREATE UNLOGGED TABLE {staging} (LIKE {table.name} INCLUDING DEFAULTS)")
+    )
+
+    stream = CopyStream(rows, columns)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {staging} ({column_list}) FROM STDIN WITH (FORMAT csv)", stream
+    )
+    cursor.close()
+
+    if update:
+        key_list = ", ".join(column.name for column in table.primary_key)
+        set_list = ", ".join(f"{column} = EXCLUDED.{column}" for column in update)
+        # an upsert can't touch the same row twice so staged duplicates go first
+        merge = f"""INSERT INTO {table.name} ({column_list})
+            SELECT DISTINCT ON ({key_list}) {column_list} FROM {staging}
+            ON CONFLICT ({key_list}) DO UPDATE SET {set_list}"""
+    else:
+        merge = f"""INSERT INTO {table.name} ({column_list})
+            SELECT {column_list} FROM {staging}
+            ON CONFLICT DO NOTHING"""
+    connection.execute(text(merge))
+    connection.execute(text(f"DROP TABLE {staging}"))
+    session.commit()
+    if stage is not None:
+        stage.add(db=time.perf_counter() - start - stream.waiting)
+    return stream.count
+
+
+class KeyIndex:
+    """
+    In memory sets of the keys of the parent tables, loaded once per run, so
+    rows for the association tables can be checked without a query per row.
+    Counts how many rows were dropped and why in the Counter given.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.keys = {}
+        self.lock = threading.Lock()
+
+    def load(self, column, key):
+        # stages run concurrently and may share keys so each is loaded once
+        with self.lock:
+            if column not in self.keys:
+                self.keys[column] = set(k for (k,) in self.session.query(key))
+
+    def filter(self, rows, dropped):
+        for row in rows:
+            if self.check(row, dropped):
+                yield row
+
+    def check(self, row, dropped):
+        for column, value in row.items():
+            if not value:
+                dropped[f"missing {column}"] += 1
+                return False
+            keys = self.keys.get(column)
+            if keys is not None and value not in keys:
+                dropped[f"unknown {column}"] += 1
+                return False
+        return True
+
+    @staticmethod
+    def report(dropped):
+        for reason, count in sorted(dropped.items()):
+            print(f"dropped {count} rows with {reason}")
+
+
+@contextmanager
+def search_path(session, schema):
+    """
+    Puts schema first on the search path of every connection checked out in
+    the block, so the models and raw sql read and write the tables there
+    """
+    if schema is None:
+        yield
+        return
+
+    def set_search_path(dbapi_connection, connection_record, connection_proxy):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"SET search_path TO {schema}, public")
+        cursor.close()
+
+    engine = session.get_bind()
+    session.close()
+    event.listen(engine, "checkout", set_search_path)
+    try:
+        yield
+    finally:
+        session.close()
+        event.remove(engine, "checkout", set_search_path)
+        # pooled connections would otherwise keep the shadow search path
+        engine.dispose()
+
+
+def create_shadow_tables(session, tables, schema="shadow", copy=()):
+    """
+    Creates empty copies of tables in schema, except for those in copy which
+    are created with the current contents of the live table
+    """
+    session.execute(text(f"DROP SCHEMA IF EXISTS {schema} CASCADE"))
+    session.execute(text(f"CREATE SCHEMA {schema}"))
+    for table in tables:
+        session.execute(
+            text(f"CREATE TABLE {schema}.{table} (LIKE public.{table} INCLUDING ALL)")
+        )
+        if table in copy:
+            session.execute(
+                text(f"INSERT INTO {schema}.{table} SELECT * FROM public.{table}")
+            )
+    session.commit()
+
+
+def swap_shadow_tables(session, tables, schema="shadow"):
+    """
+    Swaps the loaded shadow tables in for the live ones in one transaction,
+    so readers see either the old data or the new, never a partial load.
+
+    Foreign keys between the swapped tables are recreated on the shadow
+    tables first. Foreign keys from other tables, e.g. reports, are moved
+    across as NOT VALID as existing reports may refer to rows that are no
+    longer in the new data.
+    """
+    foreign_keys = session.execute(
+        text(
+            """SELECT conname AS name,
+            conrelid::regclass::text AS table_name,
+            confrelid::regclass::text AS referenced,
+            pg_get_constraintdef(oid) AS definition
+            FROM pg_constraint
+            WHERE contype = 'f' AND connamespace = 'public'::regnamespace"""
+        )
+    ).fetchall()
+    internal = [
+        fk for fk in foreign_keys if fk.table_name in tables and fk.referenced in tables
+    ]
+    external = [
+        fk
+        for fk in foreign_keys
+        if fk.table_name not in tables and fk.referenced in tables
+    ]
+
+    for fk in internal:
+        definition = fk.definition.replace(
+            f"REFERENCES {fk.referenced}(", f"REFERENCES {schema}.{fk.referenced}("
+        )
+        session.execute(
+            text(
+                f'ALTER TABLE {schema}.{fk.table_name} ADD CONSTRAINT "{fk.name}" {definition}'
+            )
+        )
+    for table in tables:
+        session.execute(text(f"ANALYZE {schema}.{table}"))
+    session.commit()
+
+    for fk in external:
+        session.execute(
+            text(f'ALTER TABLE {fk.table_name} DROP CONSTRAINT "{fk.name}"')
+        )
+    session.execute(text("DROP SCHEMA IF EXISTS retired CASCADE"))
+    session.execute(text("CREATE SCHEMA retired"))
+    for table in tables:
+        session.execute(text(f"ALTER TABLE public.{table} SET SCHEMA retired"))
+        session.execute(text(f"ALTER TABLE {schema}.{table} SET SCHEMA public"))
+    for fk in external:
+        session.execute(
+            text(
+                f'ALTER TABLE {fk.table_name} ADD CONSTRAINT "{fk.name}" {fk.definition} NOT VALID'
+            )
+        )
+    session.execute(text("DROP SCHEMA retired CASCADE"))
+    session.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+    session.commit()
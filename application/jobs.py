@@ -0,0 +1,226 @@
+import datetime
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from sqlalchemy import case, func, literal, select, update
+from sqlalchemy.dialects.postgresql import insert
+
+from application.extensions import db
+from application.models import Job
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+BACKOFF = 30
+MAX_BACKOFF = 3600
+
+
+def enqueue(session, jobs, batch_size=1000):
+    """
+    Adds jobs, each a dict of kind, key, payload and optionally priority.
+    A job whose key is already done or failed is put back on the queue, one
+    that is queued or running is left alone.
+    """
+    now = datetime.datetime.utcnow()
+    for start in range(0, len(jobs), batch_size):
+        values = [
+            {
+                "priority": 0,
+                **job,
+                "status": QUEUED,
+                "attempts": 0,
+                "run_after": now,
+                "created_date": now,
+            }
+            for job in jobs[start : start + batch_size]
+        ]
+        stmt = insert(Job).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Job.key],
+            set_=dict(
+                payload=stmt.excluded.payload,
+                priority=stmt.excluded.priority,
+                status=QUEUED,
+                attempts=0,
+                run_after=stmt.excluded.run_after,
+                last_error=None,
+            ),
+            where=Job.status.in_([DONE, FAILED]),
+        )
+        session.execute(stmt)
+    session.commit()
+
+
+def expire(session, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+    """
+    Jobs left running by a worker that stopped renewing its lease, most
+    likely because the job took the worker down, are failed once out of
+    attempts and otherwise queued again with the same backoff as finish
+    """
+    now = datetime.datetime.utcnow()
+    delay = func.least(backoff * func.power(2, Job.attempts - 1), max_backoff)
+    session.execute(
+        update(Job)
+        .where(Job.status == RUNNING, Job.locked_until < now)
+        .values(
+            status=case((Job.attempts >= Job.max_attempts, FAILED), else_=QUEUED),
+            run_after=now + literal(datetime.timedelta(seconds=1)) * delay,
+            locked_by=None,
+            locked_until=None,
+            finished_date=now,
+            last_error="lease expired",
+        )
+    )
+
+
+def claim(session, worker, lease=300):
+    """
+    Takes the next job off the queue, highest priority first, after
+    expiring jobs whose lease has run out. SKIP LOCKED means concurrent
+    workers never wait on or take the same job.
+    """
+    expire(session)
+    now = datetime.datetime.utcnow()
+    claimable = (
+        select(Job.id)
+        .where(Job.status == QUEUED, Job.run_after <= now)
+        .order_by(Job.priority.desc(), Job.run_after, Job.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    stmt = (
+        update(Job)
+        .where(Job.id == claimable)
+        .values(
+            status=RUNNING,
+            attempts=Job.attempts + 1,
+            locked_by=worker,
+            locked_until=now + datetime.timedelta(seconds=lease),
+            started_date=now,
+        )
+        .returning(
+            Job.id, Job.kind, Job.key, Job.payload, Job.attempts, Job.max_attempts
+        )
+    )
+    job = session.execute(stmt).first()
+    session.commit()
+    return job
+
+
+def renew(session, job, worker, lease=300):
+    locked_until = datetime.datetime.utcnow() + datetime.timedelta(seconds=lease)
+    session.execute(
+        update(Job)
+        .where(Job.id == job.id, Job.locked_by == worker)
+        .values(locked_until=locked_until)
+    )
+    session.commit()
+
+
+def finish(
+    session, job, worker, duration, error=None, backoff=BACKOFF, max_backoff=MAX_BACKOFF
+):
+    """
+    Marks a job done, or on error puts it back on the queue with
+    exponential backoff until it runs out of attempts. Returns None if the
+    worker lost its lease and the job is no longer its own.
+    """
+    now = datetime.datetime.utcnow()
+    values = dict(
+        locked_by=None,
+        locked_until=None,
+        finished_date=now,
+        duration=duration,
+        last_error=error,
+    )
+    if error is None:
+        values["status"] = DONE
+    elif job.attempts >= job.max_attempts:
+        values["status"] = FAILED
+    else:
+        delay = min(backoff * 2 ** (job.attempts - 1), max_backoff)
+        values["status"] = QUEUED
+        values["run_after"] = now + datetime.timedelta(seconds=delay)
+    result = session.execute(
+        update(Job).where(Job.id == job.id, Job.locked_by == worker).values(**values)
+    )
+    session.commit()
+    return values["status"] if result.rowcount else None
+
+
+class Worker:
+    """
+    Claims and runs jobs one at a time until stopped, or with burst until
+    the queue is empty. handlers maps each job kind to a function that
+    takes the job and raises if it fails.
+
+    The lease on the running job is renewed in the background, so a long
+    job isn't taken by another worker while a worker that dies loses it
+    only until the lease runs out. SIGTERM lets the running job finish.
+    """
+
+    def __init__(self, app, handlers, metrics, lease=300, poll_interval=5):
+        self.app = app
+        self.handlers = handlers
+        self.metrics = metrics
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+
+    def stop(self, *args):
+        print(f"worker {self.name} stopping once the running job is done")
+        self.stopping.set()
+
+    def run(self, burst=False):
+        signal.signal(signal.SIGTERM, self.stop)
+        while not self.stopping.is_set():
+            with self.app.app_context():
+                job = claim(db.session, self.name, self.lease)
+            if job is None:
+                if burst:
+                    return
+                self.stopping.wait(self.poll_interval)
+                continue
+            self.run_job(job)
+
+    def run_job(self, job):
+        self.metrics.log("job start", job=job.id, kind=job.kind, key=job.key)
+        done = threading.Event()
+        renewer = threading.Thread(target=self.renew, args=(job, done), daemon=True)
+        renewer.start()
+        start = time.perf_counter()
+        error = None
+        try:
+            with self.app.app_context():
+                self.handlers[job.kind](job)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+        finally:
+            done.set()
+            renewer.join()
+        duration = time.perf_counter() - start
+        with self.app.app_context():
+            status = finish(db.session, job, self.name, duration, error)
+        self.metrics.log(
+            "job stop",
+            job=job.id,
+            kind=job.kind,
+            key=job.key,
+            status=status or "lost lease",
+            attempts=job.attempts,
+            elapsed=round(duration, 3),
+        )
+
+    def renew(self, job, done):
+        while not done.wait(self.lease / 3):
+            with self.app.app_context():
+                renew(db.session, job, self.name, self.lease)
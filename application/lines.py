@@ -0,0 +1,82 @@
+from bisect import bisect_right
+
+
+class LineRanges:
+    """
+    A set of line numbers stored as sorted, non overlapping inclusive ranges
+    flattened into one list, e.g. lines 1-3 and 7 are [1, 3, 7, 7]. An issue
+    that is on every line of a resource takes two numbers rather than one
+    per line.
+
+    Lines usually arrive in order, which extends or appends to the last
+    range. Anything out of order is held back and merged in when the ranges
+    are next read.
+    """
+
+    def __init__(self, ranges=None):
+        self._ranges = list(ranges or [])
+        self._pending = []
+
+    @classmethod
+    def from_lines(cls, lines):
+        line_ranges = cls()
+        for line in sorted(set(lines)):
+            line_ranges.add(line)
+        return line_ranges
+
+    def add(self, line):
+        ranges = self._ranges
+        if not ranges or line > ranges[-1] + 1:
+            ranges.extend([line, line])
+        elif line == ranges[-1] + 1:
+            ranges[-1] = line
+        elif line < ranges[-2]:
+            self._pending.append(line)
+
+    @property
+    def ranges(self):
+        if self._pending:
+            lines, self._pending = self._pending, []
+            self._ranges = LineRanges.from_lines(list(self) + lines)._ranges
+        return self._ranges
+
+    def pairs(self):
+        ranges = self.ranges
+        return zip(ranges[::2], ranges[1::2])
+
+    def __contains__(self, line):
+        ranges = self.ranges
+        # an odd position means line falls after a start and not past its end
+        position = bisect_right(ranges, line)
+        return position % 2 == 1 or (position and ranges[position - 1] == line)
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in self.pairs())
+
+    def __iter__(self):
+        for start, end in self.pairs():
+            yield from range(start, end + 1)
+
+    def __eq__(self, other):
+        return isinstance(other, LineRanges) and self.ranges == other.ranges
+
+    def __repr__(self):
+        return f"LineRanges({self.ranges})"
+
+    def page(self, offset=0, limit=100):
+        """
+        Returns up to limit lines starting from the offset-th line, without
+        expanding the ranges before it
+        """
+        lines = []
+        for start, end in self.pairs():
+            size = end - start + 1
+            if offset >= size:
+                offset -= size
+                continue
+            stop = min(end + 1, start + offset + limit - len(lines))
+            lines.extend(range(start + offset, stop))
+            offset = 0
+            if len(lines) == limit:
+                break
+        return lines
@@ -0,0 +1,497 @@
+import datetime
+import sqlite3
+from collections import Counter
+from itertools import chain
+
+import requests
+from sqlalchemy import delete, func, or_, text
+from sqlalchemy.dialects.postgresql import insert
+
+from application.cache import bump_generation
+from application.extensions import db
+from application.fetch import stream_errors
+from application.ingest import KeyIndex, copy_rows
+from application.models import (
+    Collection,
+    Dataset,
+    IssueCategory,
+    IssueType,
+    LatestResource,
+    LoadCheckpoint,
+    Organisation,
+    Resource,
+    SyncWatermark,
+    dataset_resource,
+    issue_type_to_category,
+    organisation_resource,
+)
+
+resource_organisation_sql = """
+SELECT resource, organisation
+FROM resource_organisation;
+"""
+
+collection_sql = """
+SELECT collection
+FROM collection
+"""
+
+dataset_sql = """
+SELECT dataset, name, collection AS collection_id
+FROM dataset
+WHERE ("collection" IS NOT NULL AND "collection" != "");
+"""
+
+organisation_sql = """
+SELECT
+  name,
+  organisation
+FROM
+  organisation
+WHERE
+  (
+    organisation LIKE 'local-authority%'
+    or organisation LIKE 'development-corporation%'
+    or organisation LIKE 'national-park-authority%'
+  )
+  AND (
+    "entry_date" IS NULL
+    OR "entry_date" = ""
+  );
+"""
+
+latest_resource_sql = """
+INSERT INTO latest_resource (organisation, dataset, resource, start_date)
+SELECT DISTINCT ON (orgr.organisation, dr.dataset)
+  orgr.organisation, dr.dataset, dr.resource, r.start_date
+FROM dataset_resource dr
+JOIN resource r ON r.resource = dr.resource
+JOIN organisation_resource orgr ON orgr.resource = dr.resource
+ORDER BY orgr.organisation, dr.dataset, r.start_date DESC NULLS LAST, dr.resource
+"""
+
+issue_type_sql = """
+SELECT
+  i.issue_type,
+  i.name AS issue_name,
+  i.description AS issue_description,
+  s.severity AS severity,
+  s.name AS severity_name,
+  s.description AS severity_description
+FROM
+  issue_type i,
+  severity s
+WHERE
+  i.severity = s.severity;
+"""
+
+
+class LoadRun:
+    """
+    State shared by the stages of one load. Stages run on threads of their
+    own so each uses its own db.session, everything here is either read only
+    or thread safe.
+    """
+
+    def __init__(self, source, metrics, copy=False, incremental=False):
+        self.source = source
+        self.metrics = metrics
+        self.copy = copy
+        self.watermarks = get_watermarks() if incremental else {}
+        self.index = KeyIndex(db.session)
+        self.checkpoints = Checkpoints()
+        self.failed = set()
+
+
+def load_organisation(run):
+    with run.metrics.timed("organisation") as stage:
+        data = run.source.query("digital-land", organisation_sql, stage=stage).result()
+        inserts = []
+        # remove -eng from local-authority ids until digital  land db catches up
+        for org in data:
+            inserts.append(
+                {
+                    "name": org["name"],
+                    "organisation": org["organisation"].replace("-eng", ""),
+                }
+            )
+
+        stmt = insert(Organisation).values(inserts)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Organisation.organisation],
+            set_=dict(name=stmt.excluded.name),
+        )
+        write(stmt, stage)
+
+
+def load_issue_type(run):
+    with run.metrics.timed("issue_type") as stage:
+        data = run.source.query("digital-land", issue_type_sql, stage=stage).result()
+        for row in data:
+            row["category"] = issue_type_to_category.get(
+                row.get("issue_name"), IssueCategory.unknown
+            ).name
+        stmt = insert(IssueType).values(data)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IssueType.issue_type],
+            set_={
+                column: stmt.excluded[column]
+                for column in [
+                    "issue_name",
+                    "issue_description",
+                    "severity",
+                    "severity_name",
+                    "severity_description",
+                    "category",
+                ]
+            },
+        )
+        write(stmt, stage)
+
+
+def load_resource(run):
+    with run.metrics.timed("resource") as stage:
+        # the large tables are read in key order so a failed load can be
+        # resumed from the last key committed, the small ones are just rerun
+        batches = run.checkpoints.table(
+            run.source,
+            "resource",
+            "digital-land",
+            "resource",
+            ["resource", "start_date", "end_date"],
+            where=changed_since(run.watermarks.get("resource"), "{}"),
+            stage=stage,
+        )
+        if run.copy:
+            count = copy_rows(
+                db.session,
+                Resource.__table__,
+                ["resource", "start_date", "end_date"],
+                (row for data in batches for row in resource_rows(data)),
+                update=["start_date", "end_date"],
+                stage=stage,
+            )
+            print(f"copied {count} resources")
+        else:
+            for data in batches:
+                stmt = insert(Resource).values(resource_rows(data))
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[Resource.resource],
+                    set_=dict(
+                        start_date=stmt.excluded.start_date,
+                        end_date=stmt.excluded.end_date,
+                    ),
+                )
+                write(
+                    stmt,
+                    stage,
+                    run.checkpoints.position("resource", "", data[-1]["resource"]),
+                )
+        run.checkpoints.complete("resource")
+        set_watermark("resource", latest_resource_date())
+
+
+def load_organisation_resource(run):
+    with run.metrics.timed("organisation_resource") as stage:
+        run.index.load("organisation", Organisation.organisation)
+        run.index.load("resource", Resource.resource)
+        dropped = Counter()
+        batches = run.checkpoints.table(
+            run.source,
+            "organisation_resource",
+            "digital-land",
+            "resource_organisation",
+            ["resource", "organisation"],
+            where=changed_since(
+                run.watermarks.get("organisation_resource"),
+                "resource IN (SELECT resource FROM resource WHERE {})",
+            ),
+            stage=stage,
+        )
+        if run.copy:
+            count = copy_rows(
+                db.session,
+                organisation_resource,
+                ["organisation", "resource"],
+                run.index.filter(
+                    (
+                        row
+                        for data in batches
+                        for row in organisation_resource_rows(data)
+                    ),
+                    dropped,
+                ),
+                stage=stage,
+            )
+            print(f"copied {count} organisation resources")
+        else:
+            for data in batches:
+                inserts = list(
+                    run.index.filter(organisation_resource_rows(data), dropped)
+                )
+                if inserts:
+                    print(f"inserting {len(inserts)} organisation resources")
+                    stmt = insert(organisation_resource).values(inserts)
+                    stmt = stmt.on_conflict_do_nothing()
+                    write(
+                        stmt,
+                        stage,
+                        run.checkpoints.position(
+                            "organisation_resource", "", data[-1]["resource"]
+                        ),
+                    )
+        run.checkpoints.complete("organisation_resource")
+        run.index.report(dropped)
+        set_watermark("organisation_resource", latest_resource_date())
+
+
+def load_collection(run):
+    with run.metrics.timed("collection") as stage:
+        data = run.source.query("digital-land", collection_sql, stage=stage).result()
+        stmt = insert(Collection).values(data).on_conflict_do_nothing()
+        write(stmt, stage)
+
+
+def load_dataset(run):
+    with run.metrics.timed("dataset") as stage:
+        data = run.source.query("digital-land", dataset_sql, stage=stage).result()
+        stmt = insert(Dataset).values(data)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[Dataset.dataset],
+            set_=dict(
+                name=stmt.excluded.name, collection_id=stmt.excluded.collection_id
+            ),
+        )
+        write(stmt, stage)
+
+
+def load_dataset_resource(run):
+    with run.metrics.timed("dataset_resource") as stage:
+        run.index.load("dataset", Dataset.dataset)
+        run.index.load("resource", Resource.resource)
+        dropped = Counter()
+        filters = [None]
+        if run.watermarks.get("dataset_resource") is not None:
+            # dataset dbs don't have resource dates so ask for the changed
+            # resources by name, in chunks to keep urls a sensible length
+            changed = changed_resources(run.watermarks["dataset_resource"])
+            filters = [
+                "resource IN ({})".format(
+                    ", ".join(f"'{resource}'" for resource in changed[i : i + 50])
+                )
+                for i in range(0, len(changed), 50)
+            ]
+        dataset_resource_batches = []
+        for dataset in Dataset.query.all():
+            batches = [
+                run.checkpoints.table(
+                    run.source,
+                    "dataset_resource",
+                    dataset.dataset,
+                    "dataset_resource",
+                    ["resource", "dataset"],
+                    where=where,
+                    part=dataset.dataset,
+                    stage=stage,
+                )
+                for where in filters
+            ]
+            dataset_resource_batches.append((dataset.dataset, chain(*batches)))
+
+        if run.copy:
+            count = copy_rows(
+                db.session,
+                dataset_resource,
+                ["dataset", "resource"],
+                run.index.filter(
+                    (
+                        row
+                        for dataset, batches in dataset_resource_batches
+                        for data in skip_failed(batches, dataset, run.failed)
+                        for row in dataset_resource_rows(data)
+                    ),
+                    dropped,
+                ),
+                stage=stage,
+            )
+            print(f"copied {count} dataset resources")
+            for dataset, batches in dataset_resource_batches:
+                if dataset not in run.failed:
+                    run.checkpoints.complete("dataset_resource", dataset)
+        else:
+            for dataset, batches in dataset_resource_batches:
+                for data in skip_failed(batches, dataset, run.failed):
+                    inserts = list(
+                        run.index.filter(dataset_resource_rows(data), dropped)
+                    )
+                    if inserts:
+                        print(
+                            f"inserting {len(inserts)} dataset resources for {dataset}"
+                        )
+                        stmt = insert(dataset_resource).values(inserts)
+                        stmt = stmt.on_conflict_do_nothing()
+                        write(
+                            stmt,
+                            stage,
+                            run.checkpoints.position(
+                                "dataset_resource", dataset, data[-1]["resource"]
+                            ),
+                        )
+                if dataset not in run.failed:
+                    run.checkpoints.complete("dataset_resource", dataset)
+        run.index.report(dropped)
+        if not run.failed:
+            set_watermark("dataset_resource", latest_resource_date())
+
+
+# the stages of a load, in the order they used to run, with the stages each
+# depends on. Each stage writes the table of the same name.
+load_stages = {
+    "organisation": ([], load_organisation),
+    "issue_type": ([], load_issue_type),
+    "resource": ([], load_resource),
+    "organisation_resource": (["organisation", "resource"], load_organisation_resource),
+    "collection": ([], load_collection),
+    "dataset": (["collection"], load_dataset),
+    "dataset_resource": (["dataset", "resource"], load_dataset_resource),
+}
+
+
+def write(stmt, stage, checkpoint=None):
+    # the checkpoint is committed with the rows so it never runs ahead of them
+    with stage.timer("db"):
+        db.session.execute(stmt)
+        if checkpoint is not None:
+            db.session.execute(checkpoint)
+        db.session.commit()
+
+
+class Checkpoints:
+    """
+    Tracks the last key committed for each stage, and part of a stage such
+    as a dataset, of a load so a failed load can be resumed. Rows are upserted
+    so restarting from the last committed key, inclusive, is safe.
+    """
+
+    def __init__(self):
+        self.checkpoints = {(c.stage, c.part): c for c in LoadCheckpoint.query.all()}
+
+    def table(
+        self, source, stage_name, database, table, columns, where, stage, part=""
+    ):
+        checkpoint = self.checkpoints.get((stage_name, part))
+        if checkpoint is not None and checkpoint.completed:
+            print(f"skipping {stage_name} {part} completed by an earlier load")
+            return iter([])
+        if checkpoint is not None and checkpoint.position is not None:
+            print(f"resuming {stage_name} {part} from {checkpoint.position}")
+            resume = f"{columns[0]} >= '{checkpoint.position}'"
+            where = f"({where}) AND {resume}" if where else resume
+        return source.table(
+            database, table, columns, where=where, order_by=columns[0], stage=stage
+        )
+
+    def position(self, stage_name, part, position):
+        return self._upsert(stage_name, part, position=position)
+
+    def complete(self, stage_name, part=""):
+        db.session.execute(self._upsert(stage_name, part, completed=True))
+        db.session.commit()
+
+    def _upsert(self, stage_name, part, **values):
+        stmt = insert(LoadCheckpoint).values(stage=stage_name, part=part, **values)
+        return stmt.on_conflict_do_update(
+            index_elements=[LoadCheckpoint.stage, LoadCheckpoint.part],
+            set_=dict(updated_date=datetime.datetime.utcnow(), **values),
+        )
+
+
+def refresh_latest_resources(session):
+    """
+    Rebuilds latest_resource in one transaction, so readers see either the
+    old rows or the new ones
+    """
+    session.execute(delete(LatestResource))
+    session.execute(text(latest_resource_sql))
+    bump_generation(session)
+    session.commit()
+
+
+def get_watermarks():
+    return {w.table_name: w.synced_date for w in SyncWatermark.query.all()}
+
+
+def set_watermark(table_name, synced_date):
+    if synced_date is None:
+        return
+    stmt = insert(SyncWatermark).values(table_name=table_name, synced_date=synced_date)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SyncWatermark.table_name],
+        set_=dict(
+            synced_date=stmt.excluded.synced_date,
+            updated_date=datetime.datetime.utcnow(),
+        ),
+    )
+    db.session.execute(stmt)
+    db.session.commit()
+
+
+def latest_resource_date():
+    return db.session.query(
+        func.max(func.greatest(Resource.start_date, Resource.end_date))
+    ).scalar()
+
+
+def changed_resources(since):
+    query = db.session.query(Resource.resource).filter(
+        or_(Resource.start_date >= since, Resource.end_date >= since)
+    )
+    return [resource for (resource,) in query.order_by(Resource.resource)]
+
+
+def changed_since(since, where):
+    # the watermark day itself is fetched again as the upserts make that safe
+    if since is None:
+        return None
+    condition = f"start_date >= '{since}' OR end_date >= '{since}'"
+    return where.format(condition)
+
+
+def resource_rows(data):
+    rows = []
+    for item in data:
+        rows.append(
+            {
+                "resource": item.get("resource"),
+                "start_date": item.get("start_date")
+                if item.get("start_date")
+                else None,
+                "end_date": item.get("end_date") if item.get("end_date") else None,
+            }
+        )
+    return rows
+
+
+def organisation_resource_rows(data):
+    rows = []
+    for item in data:
+        # remove -eng from local-authority ids until digital  land db catches up
+        organisation = (item.get("organisation") or "").replace("-eng", "")
+        rows.append({"resource": item.get("resource"), "organisation": organisation})
+    return rows
+
+
+def dataset_resource_rows(data):
+    rows = []
+    for item in data:
+        rows.append({"resource": item.get("resource"), "dataset": item.get("dataset")})
+    return rows
+
+
+def skip_failed(batches, dataset, failed):
+    # a dataset that can't be fetched shouldn't stop the others loading
+    try:
+        yield from batches
+    except (requests.RequestException, sqlite3.Error, *stream_errors) as e:
+        print(e)
+        failed.add(dataset)
@@ -0,0 +1,126 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    Counters for one stage of a run. Fetch threads and the writer update
+    them concurrently so all updates go through add.
+
+    fetch is the time spent getting batches ready, of which network is the
+    time spent waiting on the source, the rest is decoding. db is the time
+    spent executing and committing writes.
+    """
+
+    counters = ["rows", "batches", "bytes", "retries", "fetch", "network", "db"]
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+        for counter in self.counters:
+            setattr(self, counter, 0)
+
+    def add(self, **counts):
+        with self.lock:
+            for counter, value in counts.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    @contextmanager
+    def timer(self, counter):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(**{counter: time.perf_counter() - start})
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self):
+        elapsed = self.elapsed
+        return {
+            "stage": self.name,
+            "elapsed": round(elapsed, 3),
+            "rows": self.rows,
+            "rows_per_second": round(self.rows / elapsed, 1) if elapsed else None,
+            "batches": self.batches,
+            "bytes": self.bytes,
+            "retries": self.retries,
+            "network": round(self.network, 3),
+            "parse": round(max(self.fetch - self.network, 0), 3),
+            "db": round(self.db, 3),
+        }
+
+
+class Metrics:
+    """
+    Collects a Stage per stage of a run, logs each start and stop as a json
+    line, prints a summary table at the end and optionally posts the summary
+    to a metrics url
+    """
+
+    def __init__(self, run, sink_url=None):
+        self.run = run
+        self.sink_url = sink_url
+        self.stages = {}
+
+    def stage(self, name):
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def start(self, name):
+        stage = self.stage(name)
+        stage.started = time.perf_counter()
+        self.log("stage start", stage=name)
+        return stage
+
+    def stop(self, name):
+        stage = self.stage(name)
+        stage.finished = time.perf_counter()
+        self.log("stage stop", **stage.to_dict())
+        return stage
+
+    @contextmanager
+    def timed(self, name):
+        stage = self.start(name)
+        try:
+            yield stage
+        finally:
+            self.stop(name)
+
+    def log(self, event, **fields):
+        logger.info(json.dumps({"run": self.run, "event": event, **fields}))
+
+    def summary(self):
+        stages = [stage.to_dict() for stage in self.stages.values()]
+        columns = list(Stage("").to_dict().keys())
+        widths = {
+            column: max([len(column)] + [len(str(s[column])) for s in stages])
+            for column in columns
+        }
+        lines = [columns] + [[str(s[column]) for column in columns] for s in stages]
+        for line in lines:
+            cells = [cell.ljust(widths[column]) for cell, column in zip(line, columns)]
+            print("  ".join(cells).rstrip())
+
+        if self.sink_url:
+            try:
+                resp = requests.post(
+                    self.sink_url, json={"run": self.run, "stages": stages}
+                )
+                resp.raise_for_status()
+            except requests.RequestException as e:
+                print(f"could not send metrics: {e}")
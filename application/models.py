@@ -1,9 +1,12 @@
 import datetime
 import enum
 
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.orm import column_property
 
 from application.extensions import db
+from application.lines import LineRanges
 
 
 class DatasetStatus(enum.Enum):
@@ -107,6 +110,19 @@ action_to_issue_categories = {
     ActionCategory.check: set([IssueCategory.does_not_meet_standard]),
 }
 
+issue_name_to_category = {
+    name: category
+    for category, names in issue_category_to_type.items()
+    for name in names
+}
+
+issue_name_to_action = {
+    name: action
+    for action, categories in action_to_issue_categories.items()
+    for category in categories
+    for name in issue_category_to_type[category]
+}
+
 dataset_resource = db.Table(
     "dataset_resource",
     db.Column("dataset", db.Text, db.ForeignKey("dataset.dataset"), primary_key=True),
@@ -187,6 +203,15 @@ class IssueType(db.Model):
 
 
 class DatasetReport(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint(
+            "dataset_id",
+            "resource_id",
+            "organisation_id",
+            name="dataset_report_dataset_resource_organisation_key",
+        ),
+    )
+
     id = db.Column(db.BIGINT, db.Sequence("dataset_report_id_seq"), primary_key=True)
     dataset_id = db.Column(db.Text, db.ForeignKey("dataset.dataset"))
     dataset = db.relationship("Dataset")
@@ -195,15 +220,19 @@ class DatasetReport(db.Model):
     resource_id = db.Column(db.Text, db.ForeignKey("resource.resource"))
     resource = db.relationship("Resource")
     dataset_issues = db.relationship("DatasetIssue", back_populates="dataset_report")
+    summary = db.relationship(
+        "DatasetReportSummary", uselist=False, back_populates="dataset_report"
+    )
     created_date = db.Column(
         db.TIMESTAMP, nullable=False, default=datetime.datetime.utcnow
     )
 
+    # has_errors and has_warnings are worked out by postgres, see below
     def has_actions(self):
-        return any(i.issue.severity == "error" for i in self.dataset_issues)
+        return self.has_errors
 
     def has_recommendations(self):
-        return any(i.issue.severity == "warn" for i in self.dataset_issues)
+        return self.has_warnings
 
     # TODO- this was added before all the action category stuff and doesn't
     # make sense any more needs re working
@@ -223,20 +252,33 @@ class DatasetReport(db.Model):
         return issues
 
     def get_issues_by_action_type(self, action):
-        issues = []
-        categories = action_to_issue_categories.get(action)
-        issue_types = []
-        for category in categories:
-            issue_types.extend(list(issue_category_to_type[category]))
-
+        if self.summary is not None and not self.summary.action_counts.get(action.name):
+            return []
+        return self.get_issues_by_action()[action]
+
+    def get_issues_by_action(self):
+        """
+        Sorts the issues into each ActionCategory in a single pass. Load the
+        report with its issues and their issue types to avoid lazy loads.
+        """
+        issues = {action: [] for action in ActionCategory}
         for issue in self.dataset_issues:
-            if issue.issue.issue_name in issue_types:
-                issues.append(issue)
-
+            action = issue_name_to_action.get(issue.issue.issue_name)
+            if action is not None:
+                issues[action].append(issue)
         return issues
 
 
 class DatasetIssue(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint(
+            "dataset_report_id",
+            "issue_type",
+            "field",
+            name="dataset_issue_report_issue_type_field_key",
+        ),
+    )
+
     id = db.Column(
         db.BIGINT, db.Sequence("dataset_report_line_id_seq"), primary_key=True
     )
@@ -247,4 +289,167 @@ class DatasetIssue(db.Model):
     dataset_report = db.relationship("DatasetReport", back_populates="dataset_issues")
     field = db.Column(db.String, nullable=False)
     value = db.Column(db.String)
-    lines = db.Column(ARRAY(db.INTEGER))
+    # see LineRanges, use lines to read them
+    line_ranges = db.Column(ARRAY(db.INTEGER))
+
+    @property
+    def lines(self):
+        return LineRanges(self.line_ranges)
+
+
+class DatasetReportSummary(db.Model):
+    """
+    Issue counts for a report, kept up to date as reports are generated.
+    The counts are of DatasetIssue rows, by IssueType severity and by
+    IssueCategory and ActionCategory name.
+    """
+
+    dataset_report_id = db.Column(
+        db.BIGINT, db.ForeignKey("dataset_report.id"), primary_key=True
+    )
+    dataset_report = db.relationship("DatasetReport", back_populates="summary")
+    issue_count = db.Column(db.BIGINT, nullable=False, default=0)
+    severity_counts = db.Column(JSONB, nullable=False, default=dict)
+    category_counts = db.Column(JSONB, nullable=False, default=dict)
+    action_counts = db.Column(JSONB, nullable=False, default=dict)
+    updated_date = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+    )
+
+    def has_actions(self):
+        return self.severity_counts.get("error", 0) > 0
+
+    def has_recommendations(self):
+        return self.severity_counts.get("warn", 0) > 0
+
+
+def has_severity(severity):
+    """
+    Read from the report's summary, or worked out from its issues for a
+    report that hasn't been summarised yet
+    """
+    counted = (
+        select(
+            func.coalesce(
+                DatasetReportSummary.severity_counts[severity].astext.cast(db.Integer),
+                0,
+            )
+            > 0
+        )
+        .where(DatasetReportSummary.dataset_report_id == DatasetReport.id)
+        .scalar_subquery()
+    )
+    found = (
+        select(DatasetIssue.id)
+        .join(IssueType, DatasetIssue.issue_type == IssueType.issue_type)
+        .where(
+            DatasetIssue.dataset_report_id == DatasetReport.id,
+            IssueType.severity == severity,
+        )
+        .exists()
+    )
+    return func.coalesce(counted, found)
+
+
+# deferred so they are only worked out when needed, to get them in the same
+# query as a list of reports use .options(undefer_group("status"))
+DatasetReport.has_errors = column_property(
+    has_severity("error"), deferred=True, group="status"
+)
+DatasetReport.has_warnings = column_property(
+    has_severity("warn"), deferred=True, group="status"
+)
+
+
+class LatestResource(db.Model):
+    """
+    The newest resource of each dataset for each organisation, rebuilt at
+    the end of each load and report run
+    """
+
+    organisation = db.Column(db.Text, primary_key=True, nullable=False)
+    dataset = db.Column(db.Text, primary_key=True, nullable=False)
+    resource = db.Column(db.Text, nullable=False)
+    start_date = db.Column(db.Date)
+
+
+class SyncWatermark(db.Model):
+    table_name = db.Column(db.Text, primary_key=True, nullable=False)
+    synced_date = db.Column(db.Date, nullable=False)
+    updated_date = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+    )
+
+
+class LoadCheckpoint(db.Model):
+    stage = db.Column(db.Text, primary_key=True, nullable=False)
+    part = db.Column(db.Text, primary_key=True, nullable=False, default="")
+    position = db.Column(db.Text)
+    completed = db.Column(db.Boolean, nullable=False, default=False)
+    updated_date = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+    )
+
+
+class IssueCache(db.Model):
+    __table_args__ = (
+        db.Index("issue_cache_dataset_resource_idx", "dataset", "resource"),
+    )
+
+    url = db.Column(db.Text, primary_key=True, nullable=False)
+    dataset = db.Column(db.Text)
+    resource = db.Column(db.Text)
+    etag = db.Column(db.Text)
+    last_modified = db.Column(db.Text)
+    digest = db.Column(db.Text, nullable=False)
+    updated_date = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+    )
+
+
+class Job(db.Model):
+    __table_args__ = (db.Index("job_status_run_after_idx", "status", "run_after"),)
+
+    id = db.Column(db.BIGINT, db.Sequence("job_id_seq"), primary_key=True)
+    kind = db.Column(db.Text, nullable=False)
+    key = db.Column(db.Text, nullable=False, unique=True)
+    payload = db.Column(JSONB, nullable=False, default=dict)
+    priority = db.Column(db.Integer, nullable=False, default=0)
+    status = db.Column(db.Text, nullable=False, default="queued")
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_after = db.Column(
+        db.TIMESTAMP, nullable=False, default=datetime.datetime.utcnow
+    )
+    locked_by = db.Column(db.Text)
+    locked_until = db.Column(db.TIMESTAMP)
+    last_error = db.Column(db.Text)
+    created_date = db.Column(
+        db.TIMESTAMP, nullable=False, default=datetime.datetime.utcnow
+    )
+    started_date = db.Column(db.TIMESTAMP)
+    finished_date = db.Column(db.TIMESTAMP)
+    duration = db.Column(db.Float)
+
+
+class DataGeneration(db.Model):
+    name = db.Column(db.Text, primary_key=True, nullable=False)
+    generation = db.Column(db.BIGINT, nullable=False, default=0)
+    updated_date = db.Column(
+        db.TIMESTAMP,
+        nullable=False,
+        default=datetime.datetime.utcnow,
+        onupdate=datetime.datetime.utcnow,
+    )
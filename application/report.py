@@ -0,0 +1,633 @@
+import asyncio
+import datetime
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from sqlalchemy import delete, func, select, text, tuple_
+from sqlalchemy.dialects.postgresql import insert
+
+from application.cache import bump_generation
+from application.extensions import db
+from application.fetch import aread_rows, create_async_client
+from application.lines import LineRanges
+from application.metrics import Stage
+from application.models import (
+    DatasetIssue,
+    DatasetReport,
+    DatasetReportSummary,
+    IssueCache,
+    IssueCategory,
+    IssueType,
+    issue_name_to_action,
+    issue_name_to_category,
+)
+
+retry_statuses = [429, 500, 502, 503, 504]
+
+report_sql = """SELECT d.dataset, r.resource, o.organisation
+    FROM dataset d, resource r, dataset_resource dr, organisation o, organisation_resource orgr
+    WHERE d.dataset = dr.dataset
+    AND r.resource = dr.resource
+    AND dr.resource = orgr.resource
+    AND o.organisation = orgr.organisation
+    {where}
+    ORDER BY d.dataset"""
+
+# reports that are missing, or for resources started since the last run.
+# A resource without any issues has no report, but its cache entry records
+# that it has been checked.
+incremental_sql = """AND (r.start_date >= :since OR (NOT EXISTS (
+        SELECT 1 FROM dataset_report rep
+        WHERE rep.dataset_id = d.dataset
+        AND rep.resource_id = r.resource
+        AND rep.organisation_id = o.organisation
+    ) AND NOT EXISTS (
+        SELECT 1 FROM issue_cache ic
+        WHERE ic.dataset = d.dataset
+        AND ic.resource = r.resource
+        AND ic.digest = :empty_digest
+    )))"""
+
+# the digest of a resource without any issue rows
+empty_digest = hashlib.sha256().hexdigest()
+
+
+def issue_url(base_url, dataset, resource):
+    return f"{base_url}/{dataset}-issue.csv?_stream=on&_col=resource&_col=field&_col=value&_col=issue-type&_col=line-number&resource__exact={resource}"  # noqa
+
+
+def issues_url(base_url, dataset, resources):
+    return f"{base_url}/{dataset}-issue.csv?_stream=on&_col=resource&_col=field&_col=value&_col=issue-type&_col=line-number&resource__in={','.join(resources)}"  # noqa
+
+
+def aggregate_issues(batches, issues=None):
+    """
+    Totals the issues for a resource by issue type and field, with the line
+    numbers each was found on. Returns None if there were no issue rows at
+    all, in which case there is nothing to report.
+    """
+    for batch in batches:
+        if issues is None:
+            issues = {}
+        for issue in batch:
+            issue_type = issue.get("issue-type")
+            if issue_type.lower() == "unknown entity":
+                continue
+            field = issue.get("field")
+            aggregate = issues.setdefault(
+                (issue_type, field), {"count": 0, "lines": LineRanges()}
+            )
+            aggregate["count"] += 1
+            # csv values are all text
+            if issue.get("line-number"):
+                aggregate["lines"].add(int(issue["line-number"]))
+    return issues
+
+
+def save_report(session, dataset, resource, organisation, issues):
+    """
+    Writes a report and its issues with one upsert each, replacing whatever
+    an earlier run recorded for the same dataset, resource and organisation
+    """
+    stmt = insert(DatasetReport).values(
+        dataset_id=dataset,
+        resource_id=resource,
+        organisation_id=organisation,
+        created_date=datetime.datetime.utcnow(),
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint="dataset_report_dataset_resource_organisation_key",
+        set_=dict(dataset_id=stmt.excluded.dataset_id),
+    ).returning(DatasetReport.id)
+    report_id = session.execute(stmt).scalar()
+
+    stale = delete(DatasetIssue).where(DatasetIssue.dataset_report_id == report_id)
+    if issues:
+        stale = stale.where(
+            ~tuple_(DatasetIssue.issue_type, DatasetIssue.field).in_(list(issues))
+        )
+        stmt = insert(DatasetIssue).values(
+            [
+                {
+                    "dataset_report_id": report_id,
+                    "issue_type": issue_type,
+                    "field": field,
+                    "count": aggregate["count"],
+                    "line_ranges": aggregate["lines"].ranges,
+                }
+                for (issue_type, field), aggregate in issues.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint="dataset_issue_report_issue_type_field_key",
+            set_=dict(count=stmt.excluded.count, line_ranges=stmt.excluded.line_ranges),
+        )
+        session.execute(stmt)
+    session.execute(stale)
+    return report_id
+
+
+def save_cache(session, entry):
+    stmt = insert(IssueCache).values(**entry, updated_date=datetime.datetime.utcnow())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[IssueCache.url],
+        set_=dict(
+            dataset=stmt.excluded.dataset,
+            resource=stmt.excluded.resource,
+            etag=stmt.excluded.etag,
+            last_modified=stmt.excluded.last_modified,
+            digest=stmt.excluded.digest,
+            updated_date=stmt.excluded.updated_date,
+        ),
+    )
+    session.execute(stmt)
+
+
+def save_summaries(session, report_ids):
+    """
+    Recounts the issues of each report into its DatasetReportSummary, by
+    severity, category and action
+    """
+    summaries = {
+        report_id: {
+            "dataset_report_id": report_id,
+            "issue_count": 0,
+            "severity_counts": {},
+            "category_counts": {},
+            "action_counts": {},
+            "updated_date": datetime.datetime.utcnow(),
+        }
+        for report_id in report_ids
+    }
+    if not summaries:
+        return
+    query = (
+        select(
+            DatasetIssue.dataset_report_id,
+            IssueType.issue_name,
+            IssueType.severity,
+            func.count(),
+        )
+        .join(IssueType, DatasetIssue.issue_type == IssueType.issue_type)
+        .where(DatasetIssue.dataset_report_id.in_(list(summaries)))
+        .group_by(
+            DatasetIssue.dataset_report_id, IssueType.issue_name, IssueType.severity
+        )
+    )
+    for report_id, issue_name, severity, count in session.execute(query):
+        summary = summaries[report_id]
+        summary["issue_count"] += count
+        category = issue_name_to_category.get(issue_name, IssueCategory.unknown)
+        counts = [
+            (summary["severity_counts"], severity),
+            (summary["category_counts"], category.name),
+        ]
+        if issue_name in issue_name_to_action:
+            counts.append(
+                (summary["action_counts"], issue_name_to_action[issue_name].name)
+            )
+        for counter, key in counts:
+            counter[key] = counter.get(key, 0) + count
+
+    stmt = insert(DatasetReportSummary).values(list(summaries.values()))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DatasetReportSummary.dataset_report_id],
+        set_={
+            column: stmt.excluded[column]
+            for column in [
+                "issue_count",
+                "severity_counts",
+                "category_counts",
+                "action_counts",
+                "updated_date",
+            ]
+        },
+    )
+    session.execute(stmt)
+
+
+def save_missing_summaries(session, batch_size=1000):
+    """
+    Summarises reports written before summaries were kept, or left
+    unchanged since
+    """
+    missing = (
+        select(DatasetReport.id)
+        .outerjoin(DatasetReportSummary)
+        .where(DatasetReportSummary.dataset_report_id.is_(None))
+    )
+    report_ids = session.execute(missing).scalars().all()
+    for start in range(0, len(report_ids), batch_size):
+        save_summaries(session, report_ids[start : start + batch_size])
+        session.commit()
+    return len(report_ids)
+
+
+def write_reports(app, dataset, resource, organisations, issues, entry, stage):
+    with app.app_context():
+        with stage.timer("db"):
+            # committed along with the reports, so the cache and summaries
+            # never get out of step with what was written
+            save_cache(db.session, entry)
+            report_ids = [
+                save_report(db.session, dataset, resource, organisation, issues)
+                for organisation in organisations
+            ]
+            save_summaries(db.session, report_ids)
+            db.session.commit()
+
+
+def write_cache(app, entry, stage):
+    with app.app_context():
+        with stage.timer("db"):
+            save_cache(db.session, entry)
+            db.session.commit()
+
+
+def write_generation(app):
+    with app.app_context():
+        bump_generation(db.session)
+        db.session.commit()
+
+
+def digest_rows(digest, rows):
+    for row in rows:
+        digest.update("\x1f".join(row.values()).encode("utf-8") + b"\n")
+
+
+async def with_retries(fetch, retries=3, stage=None):
+    """
+    Awaits fetch(), starting again with backoff on connection errors and
+    429/5xx responses
+    """
+    for attempt in range(retries + 1):
+        try:
+            return await fetch()
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in retry_statuses or attempt == retries:
+                raise
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        if stage is not None:
+            stage.add(retries=1)
+        await asyncio.sleep(0.5 * 2**attempt)
+
+
+async def fetch_issues(
+    client, url, cached=None, batch_size=1000, retries=3, stage=None
+):
+    """
+    Streams and aggregates the issues at url.
+
+    With a cached entry the request is conditional. Returns None if the
+    page is unchanged, either because the server said so with a 304 or
+    because the rows have the same digest, otherwise the issues and a new
+    cache entry.
+    """
+    stage = stage or Stage(url)
+    headers = {}
+    if cached is not None and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached is not None and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    async def fetch():
+        async with client.stream("GET", url, headers=headers) as resp:
+            if resp.status_code == 304:
+                return None
+            resp.raise_for_status()
+            issues, digest = None, hashlib.sha256()
+            async for batch in aread_rows(resp, batch_size, stage):
+                digest_rows(digest, batch)
+                issues = aggregate_issues([batch], issues)
+        if cached is not None and cached.digest == digest.hexdigest():
+            return None
+        entry = {
+            "url": url,
+            "etag": resp.headers.get("etag"),
+            "last_modified": resp.headers.get("last-modified"),
+            "digest": digest.hexdigest(),
+        }
+        return issues, entry
+
+    return await with_retries(fetch, retries, stage)
+
+
+async def fetch_resource_issues(client, url, batch_size=1000, retries=3, stage=None):
+    """
+    Streams the issues for several resources at once and splits them up by
+    resource. Returns the issues and a digest of the rows for each resource
+    that has any, the same digest fetch_issues makes for a single resource.
+    """
+    stage = stage or Stage(url)
+
+    async def fetch():
+        found = {}
+        async with client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            async for batch in aread_rows(resp, batch_size, stage):
+                by_resource = {}
+                for row in batch:
+                    by_resource.setdefault(row["resource"], []).append(row)
+                for resource, rows in by_resource.items():
+                    issues, digest = found.setdefault(resource, ({}, hashlib.sha256()))
+                    digest_rows(digest, rows)
+                    aggregate_issues([rows], issues)
+        return {
+            resource: (issues, digest.hexdigest())
+            for resource, (issues, digest) in found.items()
+        }
+
+    return await with_retries(fetch, retries, stage)
+
+
+def batched(work, size):
+    """
+    Splits work into lists of at most size resources, all from the same
+    dataset. Work is ordered by dataset so a dataset's resources are
+    together.
+    """
+    batch = []
+    for item in work:
+        if batch and (len(batch) == size or batch[0][0] != item[0]):
+            yield batch
+            batch = []
+        batch.append(item)
+    if batch:
+        yield batch
+
+
+async def generate_reports(
+    app,
+    work,
+    base_url,
+    concurrency=100,
+    connections=20,
+    writers=4,
+    batch_size=1000,
+    retries=3,
+    resources_per_request=1,
+    cache=None,
+    reported=(),
+    generation_interval=60,
+    stage=None,
+):
+    """
+    Generates a report for each organisation of each (dataset, resource,
+    organisations) in work. The issues for a resource are fetched once
+    whichever organisations it belongs to, and with resources_per_request
+    the issues for that many resources of a dataset come in one request.
+
+    Issues are fetched with at most concurrency requests in flight, and
+    work is only taken from the list as requests finish, so it can be a
+    lazy iterable. Writes go to a small pool of writer threads, each with
+    its own app context and database session. Returns the work that failed.
+
+    cache maps issue urls to their last IssueCache entry, and is only used
+    if every report for the url is in reported, so a missing report is
+    always generated, or if the url had no issues last time, so there was
+    nothing to report.
+
+    Cached pages are invalidated by bumping the data generation at most
+    every generation_interval seconds while reports are written, and
+    once more at the end, rather than once per report.
+    """
+    cache = cache or {}
+    stage = stage or Stage("report")
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+    failed = []
+    unpublished, published = False, time.monotonic()
+
+    def cached_entry(dataset, resource, organisations):
+        cached = cache.get(issue_url(base_url, dataset, resource))
+        if cached is not None and cached.digest == empty_digest:
+            return cached
+        if all((dataset, resource, o) in reported for o in organisations):
+            return cached
+        return None
+
+    async def write(writer, dataset, resource, organisations, fetched):
+        name = f"dataset: {dataset} | resource: {resource} | organisations: {', '.join(organisations)}"  # noqa
+        if fetched is None:
+            print(f"unchanged report {name}")
+            return
+        issues, entry = fetched
+        entry = {**entry, "dataset": dataset, "resource": resource}
+        if issues is None:
+            # nothing to report, the cache entry records it was checked
+            await loop.run_in_executor(writer, write_cache, app, entry, stage)
+        else:
+            await loop.run_in_executor(
+                writer,
+                write_reports,
+                app,
+                dataset,
+                resource,
+                organisations,
+                issues,
+                entry,
+                stage,
+            )
+            await publish(writer)
+        print(f"completed report {name}")
+
+    async def publish(writer):
+        nonlocal unpublished, published
+        unpublished = True
+        if time.monotonic() - published >= generation_interval:
+            unpublished, published = False, time.monotonic()
+            await loop.run_in_executor(writer, write_generation, app)
+
+    def fail(dataset, resource, organisations, e):
+        failed.extend((dataset, resource, o) for o in organisations)
+        print(f"failed report dataset: {dataset} | resource: {resource}: {e}")
+
+    async def report(client, writer, dataset, resource, organisations):
+        try:
+            url = issue_url(base_url, dataset, resource)
+            cached = cached_entry(dataset, resource, organisations)
+            fetched = await fetch_issues(
+                client, url, cached, batch_size, retries, stage
+            )
+            await write(writer, dataset, resource, organisations, fetched)
+        except Exception as e:
+            fail(dataset, resource, organisations, e)
+
+    async def report_batch(client, writer, items):
+        dataset = items[0][0]
+        try:
+            url = issues_url(base_url, dataset, [resource for _, resource, _ in items])
+            found = await fetch_resource_issues(client, url, batch_size, retries, stage)
+        except Exception as e:
+            for _, resource, organisations in items:
+                fail(dataset, resource, organisations, e)
+            return
+        for _, resource, organisations in items:
+            try:
+                issues, digest = found.get(resource, (None, empty_digest))
+                cached = cached_entry(dataset, resource, organisations)
+                if cached is not None and cached.digest == digest:
+                    fetched = None
+                else:
+                    url = issue_url(base_url, dataset, resource)
+                    entry = dict(url=url, etag=None, last_modified=None, digest=digest)
+                    fetched = issues, entry
+                await write(writer, dataset, resource, organisations, fetched)
+            except Exception as e:
+                fail(dataset, resource, organisations, e)
+
+    async def run(task):
+        try:
+            await task
+        finally:
+            semaphore.release()
+
+    try:
+        async with create_async_client(connections) as client:
+            with ThreadPoolExecutor(max_workers=writers) as writer:
+                for items in batched(work, resources_per_request):
+                    await semaphore.acquire()
+                    if resources_per_request == 1:
+                        task = report(client, writer, *items[0])
+                    else:
+                        task = report_batch(client, writer, items)
+                    task = asyncio.create_task(run(task))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                await asyncio.gather(*tasks)
+    finally:
+        if unpublished:
+            write_generation(app)
+
+    return failed
+
+
+def shard_of(dataset, resource, shards):
+    """
+    Stable across processes and machines, unlike hash(). Every organisation
+    for a resource lands in the same shard.
+    """
+    digest = hashlib.sha1(f"{dataset}/{resource}".encode()).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def report_work(session, shard=0, shards=1, since=None):
+    if since is None:
+        sql = report_sql.format(where="")
+    else:
+        sql = report_sql.format(where=incremental_sql)
+    rows = session.execute(
+        text(sql), {"since": since, "empty_digest": empty_digest}
+    ).fetchall()
+    # grouped by resource so its issues are only fetched once
+    work = {}
+    for dataset, resource, organisation in rows:
+        if shard_of(dataset, resource, shards) == shard:
+            work.setdefault((dataset, resource), []).append(organisation)
+    return [(dataset, resource, orgs) for (dataset, resource), orgs in work.items()]
+
+
+def cache_entries(session, *criteria):
+    query = session.query(
+        IssueCache.url,
+        IssueCache.etag,
+        IssueCache.last_modified,
+        IssueCache.digest,
+    )
+    return {row.url: row for row in query.filter(*criteria)}
+
+
+def reported_keys(session, *criteria):
+    query = session.query(
+        DatasetReport.dataset_id,
+        DatasetReport.resource_id,
+        DatasetReport.organisation_id,
+    )
+    return set(query.filter(*criteria))
+
+
+def report_resource(app, base_url, dataset, resource, organisations, stage=None):
+    """
+    Generates the reports for a single resource, as a report job does.
+    Returns the reports that failed.
+    """
+    url = issue_url(base_url, dataset, resource)
+    with app.app_context():
+        cache = cache_entries(db.session, IssueCache.url == url)
+        reported = reported_keys(
+            db.session,
+            DatasetReport.dataset_id == dataset,
+            DatasetReport.resource_id == resource,
+        )
+        db.session.remove()
+    return asyncio.run(
+        generate_reports(
+            app,
+            [(dataset, resource, organisations)],
+            base_url,
+            concurrency=1,
+            connections=1,
+            writers=1,
+            batch_size=app.config["BATCH_SIZE"],
+            retries=app.config["FETCH_RETRIES"],
+            cache=cache,
+            reported=reported,
+            stage=stage,
+        )
+    )
+
+
+def run_reports(
+    app, base_url, shard=0, shards=1, since=None, resources_per_request=1, stage=None
+):
+    """
+    Generates the reports in one shard of the work, only the incremental
+    work if since is given. Returns how many reports there were and the
+    ones that failed.
+    """
+    with app.app_context():
+        work = report_work(db.session, shard, shards, since)
+        cache = cache_entries(db.session)
+        reported = reported_keys(db.session)
+        db.session.remove()
+    failed = asyncio.run(
+        generate_reports(
+            app,
+            work,
+            base_url,
+            concurrency=app.config["REPORT_CONCURRENCY"],
+            connections=app.config["REPORT_CONNECTIONS"],
+            writers=app.config["REPORT_WRITERS"],
+            batch_size=app.config["BATCH_SIZE"],
+            retries=app.config["FETCH_RETRIES"],
+            resources_per_request=resources_per_request,
+            cache=cache,
+            reported=reported,
+            generation_interval=app.config["GENERATION_INTERVAL"],
+            stage=stage,
+        )
+    )
+    return sum(len(organisations) for _, _, organisations in work), failed
+
+
+def report_process(base_url, shard, shards, since=None, resources_per_request=1):
+    """
+    Entry point for a worker process, which builds an app of its own. The
+    stage counters are returned so the parent can total them.
+    """
+    from application.wsgi import app
+
+    stage = Stage("report")
+    count, failed = run_reports(
+        app, base_url, shard, shards, since, resources_per_request, stage
+    )
+    return (
+        count,
+        failed,
+        {counter: getattr(stage, counter) for counter in stage.counters},
+    )
@@ -0,0 +1,55 @@
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+
+def run_stages(stages, selected, max_workers=None):
+    """
+    Runs the selected stages, each as soon as the stages it depends on have
+    finished, so independent stages run concurrently. Stages are a dict of
+    name to (dependencies, callable). Each stage runs on a thread of its own
+    with its own app context, and so its own database session and
+    connection. Dependencies that aren't selected are taken to be loaded
+    already. Returns the names of the stages that failed or were not run
+    because a dependency failed.
+    """
+    app = current_app._get_current_object()
+
+    def run(name):
+        with app.app_context():
+            stages[name][1]()
+
+    pending = list(selected)
+    running = {}
+    done = set()
+    failed = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(selected) or 1) as executor:
+        while pending or running:
+            for name in list(pending):
+                depends = [d for d in stages[name][0] if d in selected]
+                if any(d in failed for d in depends):
+                    print(f"not running {name} as a stage it depends on failed")
+                    pending.remove(name)
+                    failed.add(name)
+                elif all(d in done for d in depends):
+                    pending.remove(name)
+                    running[executor.submit(run, name)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    done.add(name)
+                except Exception:
+                    logger.exception(f"stage {name} failed")
+                    failed.add(name)
+
+    return failed
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import Future
+from urllib.parse import quote
+
+from application.fetch import Fetcher, create_session
+from application.metrics import Stage
+
+
+class DatasetteSource:
+    """
+    Reads digital land data from datasette. Queries return futures of the
+    json result and tables are streamed as csv and returned as iterators of
+    row batches, both fetched in the background by a Fetcher.
+    """
+
+    def __init__(self, datasette_url, workers=8, retries=3, batch_size=5000):
+        self.datasette_url = datasette_url
+        self.batch_size = batch_size
+        session = create_session(pool_size=workers, retries=retries)
+        self.fetcher = Fetcher(session, max_workers=workers, retries=retries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fetcher.close()
+
+    def query(self, database, sql, stage=None):
+        url = f"{self.datasette_url}/{database}.json?sql={sql.strip()}&_shape=array"
+        return self.fetcher.get(url, stage)
+
+    def table(self, database, table, columns, where=None, order_by=None, stage=None):
+        url = self.table_url(database, table, columns, where, order_by)
+        print(f"{database}/{table} url: {url}")
+        if not order_by:
+            return self.fetcher.stream(url, self.batch_size, stage)
+
+        def resume(last):
+            # the same resume as a load checkpoint's
+            after = f"{order_by} >= '{last}'"
+            resumed = f"({where}) AND {after}" if where else after
+            return self.table_url(database, table, columns, resumed, order_by)
+
+        return self.fetcher.stream(url, self.batch_size, stage, resume, order_by)
+
+    def table_url(self, database, table, columns, where=None, order_by=None):
+        url = f"{self.datasette_url}/{database}/{table}.csv?_stream=on"
+        url += "".join(f"&_col={column}" for column in columns)
+        if where:
+            url += f"&_where={quote(where)}"
+        if order_by:
+            url += f"&_sort={order_by}"
+        return url
+
+
+class SqliteSource:
+    """
+    Reads the same data from a local copy of the digital-land sqlite
+    database. Dataset databases are looked for in the same directory,
+    named after the dataset, e.g. conservation-area.sqlite3
+    """
+
+    def __init__(self, path, batch_size=5000):
+        self.path = path
+        self.batch_size = batch_size
+        # sqlite connections can't be shared between threads, and load
+        # stages run on threads of their own
+        self.local = threading.local()
+        self.connections = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for connection in self.connections:
+            connection.close()
+
+    def connect(self, database):
+        connections = self.local.__dict__.setdefault("connections", {})
+        if database not in connections:
+            path = self.path
+            if database != "digital-land":
+                path = os.path.join(os.path.dirname(self.path), f"{database}.sqlite3")
+            connection = sqlite3.connect(
+                f"file:{path}?mode=ro", uri=True, check_same_thread=False
+            )
+            connection.row_factory = sqlite3.Row
+            connections[database] = connection
+            self.connections.append(connection)
+        return connections[database]
+
+    def query(self, database, sql, stage=None):
+        stage = stage or Stage(sql)
+        future = Future()
+        with stage.timer("fetch"):
+            rows = [dict(row) for row in self.connect(database).execute(sql)]
+        stage.add(rows=len(rows), batches=1)
+        future.set_result(rows)
+        return future
+
+    def table(self, database, table, columns, where=None, order_by=None, stage=None):
+        sql = f"SELECT {', '.join(columns)} FROM {table}"
+        if where:
+            sql += f" WHERE {where}"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        return self.batches(database, sql, stage or Stage(table))
+
+    def batches(self, database, sql, stage):
+        cursor = self.connect(database).execute(sql)
+        while True:
+            with stage.timer("fetch"):
+                rows = [dict(row) for row in cursor.fetchmany(self.batch_size)]
+            if not rows:
+                return
+            stage.add(rows=len(rows), batches=1)
+            yield rows
@@ -13,6 +13,22 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DATASETTE_URL = os.getenv("DATASETTE_URL", "https://datasette.digital-land.info")
     S3_URL = os.getenv("S3_URL")
+    FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 8))
+    FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", 3))
+    BATCH_SIZE = int(os.getenv("BATCH_SIZE", 5000))
+    METRICS_URL = os.getenv("METRICS_URL")
+    REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", 100))
+    REPORT_CONNECTIONS = int(os.getenv("REPORT_CONNECTIONS", 20))
+    REPORT_WRITERS = int(os.getenv("REPORT_WRITERS", 4))
+    ISSUES_URL = os.getenv(
+        "ISSUES_URL", "https://digital-land-issues.herokuapp.com/dataset-issue"
+    )
+    JOB_LEASE = int(os.getenv("JOB_LEASE", 300))
+    PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", 256))
+    # how often a report run makes its new reports visible to cached pages
+    GENERATION_INTERVAL = int(os.getenv("GENERATION_INTERVAL", 60))
+    # part of page etags, so a release with new templates isn't served a 304
+    RELEASE_VERSION = os.getenv("HEROKU_RELEASE_VERSION", "")
 
 
 class DevelopmentConfig(Config):
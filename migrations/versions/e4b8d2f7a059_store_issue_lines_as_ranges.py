@@ -0,0 +1,81 @@
+"""store issue lines as ranges
+
+Revision ID: e4b8d2f7a059
+Revises: c7e2a9f4b136
+Create Date: 2022-07-12 15:08:33.671942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "e4b8d2f7a059"
+down_revision = "c7e2a9f4b136"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "dataset_issue",
+        sa.Column("line_ranges", postgresql.ARRAY(sa.INTEGER()), nullable=True),
+    )
+    # consecutive lines have the same line - row_number, which groups
+    # them into ranges, each flattened to its start and end
+    op.execute(
+        """
+        UPDATE dataset_issue di
+        SET line_ranges = r.line_ranges
+        FROM (
+            SELECT id, array_agg(bound ORDER BY start, position) AS line_ranges
+            FROM (
+                SELECT id, min(line) AS start, max(line) AS finish
+                FROM (
+                    SELECT id, line,
+                    line - row_number() OVER (PARTITION BY id ORDER BY line) AS grp
+                    FROM (
+                        SELECT DISTINCT id, unnest(lines) AS line
+                        FROM dataset_issue
+                    ) l
+                    WHERE line IS NOT NULL
+                ) g
+                GROUP BY id, grp
+            ) islands,
+            LATERAL (VALUES (1, start), (2, finish)) AS b(position, bound)
+            GROUP BY id
+        ) r
+        WHERE di.id = r.id
+        """
+    )
+    op.drop_column("dataset_issue", "lines")
+
+
+def downgrade():
+    op.add_column(
+        "dataset_issue",
+        sa.Column(
+            "lines",
+            postgresql.ARRAY(sa.INTEGER()),
+            autoincrement=False,
+            nullable=True,
+        ),
+    )
+    op.execute(
+        """
+        UPDATE dataset_issue di
+        SET lines = r.lines
+        FROM (
+            SELECT id, array_agg(line ORDER BY line) AS lines
+            FROM (
+                SELECT id, line_ranges[i] AS start, line_ranges[i + 1] AS finish
+                FROM dataset_issue, generate_subscripts(line_ranges, 1) AS i
+                WHERE i % 2 = 1
+            ) p,
+            generate_series(start, finish) AS line
+            GROUP BY id
+        ) r
+        WHERE di.id = r.id
+        """
+    )
+    op.drop_column("dataset_issue", "line_ranges")
@@ -0,0 +1,77 @@
+from unittest import mock
+
+import pytest
+from flask import Flask
+
+from application import cache
+from application.cache import PageCache
+
+
+@pytest.fixture
+def page_app():
+    app = Flask(__name__)
+    app.config.update(RELEASE_VERSION="v42", PAGE_CACHE_SIZE=2)
+    page_cache = PageCache(app)
+    rendered = []
+
+    @app.route("/page/<name>")
+    @page_cache.cached
+    def page(name):
+        rendered.append(name)
+        return f"page {name}"
+
+    app.rendered = rendered
+    app.page_cache = page_cache
+    return app
+
+
+def get(app, path, generation=1, **headers):
+    with mock.patch.object(cache, "get_generation", return_value=generation):
+        return app.test_client().get(path, headers=headers)
+
+
+def test_cached_page_is_only_rendered_once(page_app):
+    first = get(page_app, "/page/a")
+    second = get(page_app, "/page/a")
+    assert first.data == second.data == b"page a"
+    assert page_app.rendered == ["a"]
+
+
+def test_page_etag_is_the_generation_and_release(page_app):
+    resp = get(page_app, "/page/a", generation=7)
+    assert resp.headers["ETag"] == '"7-v42"'
+    assert resp.cache_control.no_cache
+
+
+def test_matching_etag_gets_304_without_rendering(page_app):
+    resp = get(page_app, "/page/a", **{"If-None-Match": '"1-v42"'})
+    assert resp.status_code == 304
+    assert resp.data == b""
+    assert resp.headers["ETag"] == '"1-v42"'
+    assert page_app.rendered == []
+
+
+def test_old_etag_gets_the_page(page_app):
+    resp = get(page_app, "/page/a", generation=2, **{"If-None-Match": '"1-v42"'})
+    assert resp.status_code == 200
+    assert page_app.rendered == ["a"]
+
+
+def test_new_generation_renders_again(page_app):
+    get(page_app, "/page/a", generation=1)
+    get(page_app, "/page/a", generation=2)
+    assert page_app.rendered == ["a", "a"]
+
+
+def test_least_recently_used_page_is_dropped(page_app):
+    for name in ["a", "b", "a", "c", "a", "b"]:
+        get(page_app, f"/page/{name}")
+    # b was dropped for c, as a had been used since
+    assert page_app.rendered == ["a", "b", "c", "b"]
+    assert len(page_app.page_cache.pages) == 2
+
+
+def test_query_string_is_not_part_of_the_key(page_app):
+    get(page_app, "/page/a?x=1")
+    get(page_app, "/page/a?x=2")
+    assert page_app.rendered == ["a"]
@@ -0,0 +1,191 @@
+import asyncio
+import csv
+import io
+
+import httpx
+import pytest
+from urllib3.exceptions import ProtocolError
+
+from application.fetch import aread_rows, resume_rows, split_records
+from application.metrics import Stage
+
+body = (
+    "resource,field,value,issue-type,line-number\r\n"
+    'r1,name,"Smith, John",invalid,2\r\n'
+    'r1,notes,"first line\r\nsecond ""quoted"" line",too long,3\r\n'
+    "r2,,,missing value,\r\n"
+    'r2,geometry,"POINT (1 2)",invalid geometry,10\r\n'
+)
+
+
+def chunked(text, size):
+    async def chunks():
+        data = text.encode("utf-8")
+        for start in range(0, len(data), size):
+            yield data[start : start + size]
+
+    return chunks()
+
+
+def read_rows(text, chunk_size, batch_size=1000):
+    resp = httpx.Response(200, content=chunked(text, chunk_size))
+
+    async def read():
+        return [batch async for batch in aread_rows(resp, batch_size, Stage("test"))]
+
+    return asyncio.run(read())
+
+
+def test_split_records():
+    records, rest = split_records("a,b\nc,d\ne,")
+    assert records == ["a,b\n", "c,d\n"]
+    assert rest == "e,"
+
+
+def test_split_records_carries_the_partial_record():
+    records, rest = split_records("f\ng,h\n", "e,")
+    assert records == ["e,f\n", "g,h\n"]
+    assert rest == ""
+
+
+def test_split_records_keeps_quoted_newlines_in_the_record():
+    records, rest = split_records('a,"b\nc"\nd,"e\n')
+    assert records == ['a,"b\nc"\n']
+    assert rest == 'd,"e\n'
+
+    records, rest = split_records('f"\n', rest)
+    assert records == ['d,"e\nf"\n']
+    assert rest == ""
+
+
+def test_split_records_escaped_quotes():
+    records, rest = split_records('a,"say ""hi""\nthere"\n')
+    assert records == ['a,"say ""hi""\nthere"\n']
+    assert rest == ""
+
+
+def test_split_records_crlf():
+    records, rest = split_records("a,b\r\nc,d\r")
+    assert records == ["a,b\r\n"]
+    assert rest == "c,d\r"
+    records, rest = split_records("\n", rest)
+    assert records == ["c,d\r\n"]
+
+
+def test_aread_rows_matches_csv_at_every_chunk_size():
+    expected = list(csv.DictReader(io.StringIO(body, newline="")))
+    for chunk_size in range(1, len(body) + 1):
+        batches = read_rows(body, chunk_size)
+        assert [row for batch in batches for row in batch] == expected, chunk_size
+
+
+def test_aread_rows_batches():
+    batches = read_rows(body, 7, batch_size=3)
+    assert [len(batch) for batch in batches] == [3, 1]
+    assert batches[0][1]["value"] == 'first line\r\nsecond "quoted" line'
+
+
+def test_aread_rows_without_a_trailing_newline():
+    batches = read_rows("a,b\n1,2\n3,4", 3)
+    assert batches == [[{"a": "1", "b": "2"}, {"a": "3", "b": "4"}]]
+
+
+def test_aread_rows_header_only():
+    assert read_rows("a,b\r\n", 2) == []
+    assert read_rows("", 2) == []
+
+
+def test_aread_rows_multibyte_characters_split_across_chunks():
+    batches = read_rows("name\nCaerdydd – Cymru\n", 1)
+    assert batches == [[{"name": "Caerdydd – Cymru"}]]
+
+
+class DroppedRaw(io.RawIOBase):
+    """
+    A response body whose connection drops after fail_after bytes
+    """
+
+    retries = None
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = len(data) if fail_after is None else fail_after
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.fail_after and self.fail_after < len(self.data):
+            raise ProtocolError("Connection broken")
+        end = min(self.position + len(buffer), self.fail_after)
+        count = end - self.position
+        buffer[:count] = self.data[self.position : end]
+        self.position = end
+        return count
+
+
+class FakeResponse:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    def __init__(self, *raws):
+        self.raws = list(raws)
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        return FakeResponse(self.raws.pop(0))
+
+
+def export(resources):
+    return ("resource\n" + "".join(f"{r}\n" for r in resources)).encode()
+
+
+def test_resume_rows_starts_again_from_the_last_key():
+    first = export(["r1", "r2", "r3", "r4", "r5"])
+    session = FakeSession(
+        DroppedRaw(first, fail_after=first.index(b"r4")),
+        DroppedRaw(export(["r2", "r3", "r4", "r5"])),
+    )
+    batches = resume_rows(
+        session,
+        "/resource.csv",
+        lambda last: f"/resource.csv?from={last}",
+        "resource",
+        batch_size=2,
+        backoff_factor=0,
+        stage=Stage("test"),
+    )
+    rows = [row["resource"] for batch in batches for row in batch]
+    assert session.urls == ["/resource.csv", "/resource.csv?from=r2"]
+    # rows from the last key are fetched again
+    assert rows == ["r1", "r2", "r2", "r3", "r4", "r5"]
+
+
+def test_resume_rows_gives_up_after_retries():
+    data = export(["r1", "r2"])
+    session = FakeSession(*[DroppedRaw(data, fail_after=3) for _ in range(3)])
+    batches = resume_rows(
+        session,
+        "/resource.csv",
+        lambda last: f"/resource.csv?from={last}",
+        "resource",
+        retries=2,
+        backoff_factor=0,
+        stage=Stage("test"),
+    )
+    with pytest.raises(ProtocolError):
+        list(batches)
+    assert session.urls == ["/resource.csv"] * 3
@@ -0,0 +1,74 @@
+import datetime
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from application import commands
+from application.jobs import DONE, FAILED, QUEUED, finish
+
+
+def finish_job(attempts, error="boom", rowcount=1, max_attempts=5, **kwargs):
+    session = mock.MagicMock()
+    session.execute.return_value.rowcount = rowcount
+    job = SimpleNamespace(id=1, attempts=attempts, max_attempts=max_attempts)
+    status = finish(session, job, "worker", 1.5, error, **kwargs)
+    values = session.execute.call_args[0][0].compile().params
+    return status, values
+
+
+def test_finish_done():
+    status, values = finish_job(1, error=None)
+    assert status == DONE
+    assert values["status"] == DONE
+    assert values["locked_by"] is None
+    assert "run_after" not in values
+
+
+@pytest.mark.parametrize(
+    "attempts, delay",
+    [(1, 30), (2, 60), (3, 120), (4, 240)],
+)
+def test_finish_backs_off_exponentially(attempts, delay):
+    status, values = finish_job(attempts, max_attempts=10)
+    assert status == QUEUED
+    assert values["run_after"] - values["finished_date"] == datetime.timedelta(
+        seconds=delay
+    )
+
+
+def test_finish_backoff_is_capped():
+    status, values = finish_job(9, max_attempts=10, max_backoff=600)
+    assert values["run_after"] - values["finished_date"] == datetime.timedelta(
+        seconds=600
+    )
+
+
+def test_finish_fails_once_out_of_attempts():
+    status, values = finish_job(5)
+    assert status == FAILED
+    assert "run_after" not in values
+
+
+def test_finish_only_updates_a_job_the_worker_holds():
+    session = mock.MagicMock()
+    session.execute.return_value.rowcount = 0
+    job = SimpleNamespace(id=1, attempts=1, max_attempts=5)
+    assert finish(session, job, "worker", 1.5) is None
+    where = str(session.execute.call_args[0][0].whereclause)
+    assert "job.locked_by" in where
+
+
+def test_load_job_fails_when_datasets_could_not_be_fetched():
+    job = SimpleNamespace(payload={}, attempts=2)
+    with mock.patch.object(commands, "run_load", return_value={"tree"}) as run_load:
+        with pytest.raises(RuntimeError, match="tree"):
+            commands.run_load_job(job)
+    run_load.assert_called_once_with(incremental=False, resume=True)
+
+
+def test_load_job_succeeds():
+    job = SimpleNamespace(payload={"incremental": True}, attempts=1)
+    with mock.patch.object(commands, "run_load", return_value=set()) as run_load:
+        commands.run_load_job(job)
+    run_load.assert_called_once_with(incremental=True, resume=False)
@@ -0,0 +1,76 @@
+from application.lines import LineRanges
+
+
+def test_add_extends_the_last_range():
+    lines = LineRanges()
+    for line in [1, 2, 3, 7, 8, 10]:
+        lines.add(line)
+    assert lines.ranges == [1, 3, 7, 8, 10, 10]
+
+
+def test_add_ignores_repeated_lines():
+    lines = LineRanges()
+    for line in [1, 2, 2, 3, 3]:
+        lines.add(line)
+    assert lines.ranges == [1, 3]
+
+
+def test_out_of_order_lines_are_merged_when_read():
+    lines = LineRanges()
+    for line in [5, 6, 10, 1, 7, 2, 4]:
+        lines.add(line)
+    assert lines.ranges == [1, 2, 4, 7, 10, 10]
+    assert list(lines) == [1, 2, 4, 5, 6, 7, 10]
+
+
+def test_out_of_order_line_inside_a_range():
+    lines = LineRanges()
+    for line in [5, 6, 7, 2, 6]:
+        lines.add(line)
+    assert lines.ranges == [2, 2, 5, 7]
+
+
+def test_from_lines():
+    assert LineRanges.from_lines([3, 1, 2, 9, 2]).ranges == [1, 3, 9, 9]
+    assert LineRanges.from_lines([]).ranges == []
+
+
+def test_contains():
+    lines = LineRanges([1, 3, 7, 7, 10, 12])
+    assert [line for line in range(14) if line in lines] == [1, 2, 3, 7, 10, 11, 12]
+    assert 1 not in LineRanges()
+
+
+def test_contains_merges_pending_lines():
+    lines = LineRanges()
+    for line in [5, 1]:
+        lines.add(line)
+    assert 1 in lines
+    assert 3 not in lines
+
+
+def test_len_and_iter():
+    lines = LineRanges([1, 3, 7, 7])
+    assert len(lines) == 4
+    assert list(lines) == [1, 2, 3, 7]
+    assert list(lines.pairs()) == [(1, 3), (7, 7)]
+
+
+def test_equality():
+    assert LineRanges([1, 3]) == LineRanges.from_lines([1, 2, 3])
+    assert LineRanges([1, 3]) != LineRanges([1, 2])
+    assert LineRanges([1, 3]) != [1, 3]
+
+
+def test_page():
+    lines = LineRanges([1, 3, 7, 7, 10, 12])
+    assert lines.page(0, 2) == [1, 2]
+    assert lines.page(2, 3) == [3, 7, 10]
+    assert lines.page(4, 100) == [10, 11, 12]
+    assert lines.page(7, 10) == []
+    assert lines.page() == [1, 2, 3, 7, 10, 11, 12]
+
+
+def test_page_of_a_large_range():
+    lines = LineRanges([1, 1000000])
+    assert lines.page(999998, 5) == [999999, 1000000]
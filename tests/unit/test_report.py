@@ -0,0 +1,133 @@
+import asyncio
+from unittest import mock
+
+import httpx
+
+from application import report
+from application.lines import LineRanges
+from application.metrics import Stage
+from application.report import aggregate_issues, batched
+
+issues_csv = "resource,field,value,issue-type,line-number\nr,name,x,invalid,2\n"
+
+
+def test_batched_splits_by_size():
+    work = [("dataset", f"r{n}", ["org"]) for n in range(5)]
+    batches = list(batched(work, 2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert [item for batch in batches for item in batch] == work
+
+
+def test_batched_keeps_datasets_apart():
+    work = [
+        ("a", "r1", ["org"]),
+        ("a", "r2", ["org"]),
+        ("a", "r3", ["org"]),
+        ("b", "r4", ["org"]),
+        ("c", "r5", ["org"]),
+        ("c", "r6", ["org"]),
+    ]
+    batches = [[resource for _, resource, _ in batch] for batch in batched(work, 2)]
+    assert batches == [["r1", "r2"], ["r3"], ["r4"], ["r5", "r6"]]
+
+
+def test_batched_one_per_batch():
+    work = [("a", "r1", ["org"]), ("a", "r2", ["org"])]
+    assert list(batched(work, 1)) == [[work[0]], [work[1]]]
+
+
+def test_batched_takes_any_iterable():
+    assert list(batched(iter([]), 3)) == []
+    work = iter([("a", "r1", ["org"]), ("a", "r2", ["org"])])
+    assert next(batched(work, 1)) == [("a", "r1", ["org"])]
+
+
+def generate(work, generation_interval):
+    transport = httpx.MockTransport(
+        lambda request: httpx.Response(200, text=issues_csv)
+    )
+    writes = mock.MagicMock()
+    with mock.patch.object(
+        report, "create_async_client", lambda c: httpx.AsyncClient(transport=transport)
+    ), mock.patch.object(report, "write_reports", writes.reports), mock.patch.object(
+        report, "write_generation", writes.generation
+    ):
+        failed = asyncio.run(
+            report.generate_reports(
+                None,
+                work,
+                "http://datasette",
+                generation_interval=generation_interval,
+                stage=Stage("test"),
+            )
+        )
+    assert failed == []
+    return writes
+
+
+def test_generation_is_bumped_once_at_the_end():
+    work = [("dataset", f"r{n}", ["org"]) for n in range(5)]
+    writes = generate(work, generation_interval=3600)
+    assert writes.reports.call_count == 5
+    assert writes.generation.call_count == 1
+
+
+def test_generation_is_bumped_every_interval():
+    work = [("dataset", f"r{n}", ["org"]) for n in range(3)]
+    writes = generate(work, generation_interval=0)
+    assert writes.generation.call_count == 3
+
+
+def test_generation_is_not_bumped_without_reports():
+    writes = generate([], generation_interval=0)
+    assert writes.generation.call_count == 0
+
+
+def issue(issue_type, field, line=""):
+    return {"issue-type": issue_type, "field": field, "line-number": line}
+
+
+def test_aggregate_issues_counts_by_type_and_field():
+    batches = [
+        [issue("invalid", "name", "2"), issue("invalid", "name", "3")],
+        [issue("invalid", "geometry", "2"), issue("missing value", "name", "4")],
+    ]
+    issues = aggregate_issues(batches)
+    assert {key: value["count"] for key, value in issues.items()} == {
+        ("invalid", "name"): 2,
+        ("invalid", "geometry"): 1,
+        ("missing value", "name"): 1,
+    }
+    assert issues[("invalid", "name")]["lines"] == LineRanges([2, 3])
+
+
+def test_aggregate_issues_skips_unknown_entities():
+    batches = [[issue("Unknown entity", "reference", "2"), issue("invalid", "name")]]
+    issues = aggregate_issues(batches)
+    assert list(issues) == [("invalid", "name")]
+
+
+def test_aggregate_issues_lines_out_of_order():
+    lines = ["9", "2", "3", "10", "1", "3"]
+    issues = aggregate_issues([[issue("invalid", "name", line) for line in lines]])
+    aggregate = issues[("invalid", "name")]
+    assert aggregate["count"] == 6
+    assert aggregate["lines"].ranges == [1, 3, 9, 10]
+
+
+def test_aggregate_issues_without_line_numbers():
+    issues = aggregate_issues([[issue("invalid", "name"), issue("invalid", "name")]])
+    assert issues[("invalid", "name")]["count"] == 2
+    assert len(issues[("invalid", "name")]["lines"]) == 0
+
+
+def test_aggregate_issues_without_rows():
+    assert aggregate_issues([]) is None
+    assert aggregate_issues([[]]) == {}
+
+
+def test_aggregate_issues_adds_to_earlier_issues():
+    issues = aggregate_issues([[issue("invalid", "name", "1")]])
+    issues = aggregate_issues([[issue("invalid", "name", "2")]], issues)
+    assert issues[("invalid", "name")]["count"] == 2
+    assert list(issues[("invalid", "name")]["lines"]) == [1, 2]
@@ -0,0 +1,35 @@
+import click
+import pytest
+
+from application.commands import parse_shard
+from application.report import shard_of
+
+
+def test_shard_of_is_stable():
+    # the same across processes and machines, unlike hash()
+    assert shard_of("article-4-direction", "abc123", 4) == shard_of(
+        "article-4-direction", "abc123", 4
+    )
+    assert shard_of("conservation-area", "abc123", 1) == 0
+
+
+def test_shard_of_spreads_resources():
+    resources = [f"resource-{n}" for n in range(1000)]
+    counts = [0] * 4
+    for resource in resources:
+        shard = shard_of("conservation-area", resource, 4)
+        assert 0 <= shard < 4
+        counts[shard] += 1
+    assert min(counts) > 200
+
+
+def test_parse_shard():
+    assert parse_shard(None, None, None) == (0, 1)
+    assert parse_shard(None, None, "1/4") == (0, 4)
+    assert parse_shard(None, None, "4/4") == (3, 4)
+
+
+@pytest.mark.parametrize("value", ["0/4", "5/4", "2", "a/b", "1/2/3"])
+def test_parse_shard_rejects(value):
+    with pytest.raises(click.BadParameter):
+        parse_shard(None, None, value)